@@ -0,0 +1,90 @@
+"""
+Per-micrograph overhead of collecting the results, with the Micrograph record
+compared to the pandas Series the micrographs used before.
+
+    python benchmarks/bench_micrograph.py [number of micrographs]
+
+The results are added like in the pipeline: the CTF values and the star file
+columns of gctf, and the png and log files of motioncor and gctf. Then the
+micrograph becomes a row of the results.
+"""
+import os
+import sys
+import time
+import logging
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mpiapp'))
+
+from pipeline import Micrograph, ResultsStore
+
+
+class SeriesMicrograph:
+    """
+    The results of a micrograph in a growing pandas Series, like before
+    """
+    def __init__(self, basename, id):
+        self.id = id
+        self.basename = basename
+        self.data = pd.Series(name=self.id, data={'micrograph': self.basename})
+
+    def add_data(self, dictionary):
+        self.data = pd.concat([self.data, pd.Series(data=dictionary)])
+        self.data.name = self.id
+
+
+def results(basename):
+    """
+    :return: the dictionaries that are added to a micrograph on its way through the pipeline
+    """
+    gctf = {'Defocus_U': 21000.0, 'Defocus_V': 20000.0, 'Angle': 10.0, 'Defocus': 2.05, 'delta_Defocus': 0.1,
+            'Resolution': 4.0, '_rlnMicrographName #1': '/output/gctf/{}.mrc'.format(basename),
+            '_rlnCtfImage #2': '/output/gctf/{}.ctf:mrc'.format(basename), '_rlnDefocusU #3': '21000.00',
+            '_rlnDefocusV #4': '20000.00', '_rlnDefocusAngle #5': '10.00'}
+    motioncor_static = {'motioncor_aligned_DW': 'static/motioncor/{}_DW.png'.format(basename),
+                        'motioncor_log': 'static/motioncor/{}_DriftCorr.log'.format(basename)}
+    gctf_static = {'gctf_ctf_fit': 'static/gctf/{}.png'.format(basename),
+                   'gctf_log': 'static/gctf/{}_gctf.log'.format(basename)}
+    return [gctf, motioncor_static, gctf_static]
+
+
+def bench_series(n):
+    rows = []
+    start = time.perf_counter()
+    for i in range(n):
+        basename = 'micrograph_{:05d}'.format(i)
+        micrograph = SeriesMicrograph(basename, i)
+        for dictionary in results(basename):
+            micrograph.add_data(dictionary)
+        rows.append(micrograph.data.to_dict())
+    return time.perf_counter() - start, rows
+
+
+def bench_record(n):
+    logger = logging.getLogger('bench')
+    store = ResultsStore()
+    start = time.perf_counter()
+    for i in range(n):
+        basename = 'micrograph_{:05d}'.format(i)
+        micrograph = Micrograph(basename + '.tif', logger)
+        for dictionary in results(basename):
+            micrograph.add_data(dictionary)
+        store.append(micrograph.to_record())
+    return time.perf_counter() - start, store.snapshot()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    series_time, series_rows = bench_series(n)
+    record_time, record_rows = bench_record(n)
+    assert pd.DataFrame(series_rows).equals(pd.DataFrame(record_rows)), 'the results differ'
+
+    print('{} micrographs'.format(n))
+    print('pandas Series:     {:8.1f} μs per micrograph'.format(series_time / n * 1e6))
+    print('Micrograph record: {:8.1f} μs per micrograph'.format(record_time / n * 1e6))
+    print('speedup:           {:8.1f}x'.format(series_time / record_time))
+
+
+if __name__ == '__main__':
+    main()
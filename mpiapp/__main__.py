@@ -0,0 +1,107 @@
+"""
+Command line interface to run the pipeline without the GUI, e.g. on a GPU node without a display:
+
+    python -m mpiapp run --config my_config.json --input /path/to/frames --output /path/to/output
+
+To distribute the processing over several GPU nodes with a shared filesystem, start a coordinator
+and a worker agent on each GPU node:
+
+    python -m mpiapp coordinator --config my_config.json --input /path/to/frames --output /path/to/output --bind coordinator-node
+    python -m mpiapp agent --host coordinator-node --gpus 0 1 2 3
+"""
+import os
+import sys
+import signal
+import logging
+import argparse
+from threading import Event
+
+# the modules of the MPIApp are imported like the gui module in mpiapp.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# there is no display for matplotlib
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from pipeline import Pipeline, load_config
+from distributed import Coordinator, Agent, DEFAULT_PORT
+
+
+def run(args):
+    main_options, motioncor_options, gctf_options = load_config(args.config)
+    if args.gpus is not None:
+        main_options['GPUs'] = args.gpus
+
+    pipeline = Pipeline(main_options, motioncor_options, gctf_options, args.input, args.output,
+                        args.motioncor, args.gctf, logging.getLogger('mpiapp'))
+    run_until_interrupted(pipeline, args.files)
+
+
+def coordinator(args):
+    main_options, motioncor_options, gctf_options = load_config(args.config)
+    pipeline = Coordinator(main_options, motioncor_options, gctf_options, args.input, args.output,
+                           args.bind, args.port, logging.getLogger('mpiapp'))
+    run_until_interrupted(pipeline, args.files)
+
+
+def agent(args):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    Agent(args.host, args.port, args.gpus, args.motioncor, args.gctf, args.slots, logging.getLogger('mpiapp')).run()
+
+
+def run_until_interrupted(pipeline, files):
+    pipeline.start()
+    pipeline.add_files(files, source='manual')
+
+    # run until we get interrupted
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    # the pipeline writes the results in the background
+    while not stop.wait(10):
+        pipeline.logger.debug(pipeline.status())
+
+    pipeline.logger.info('Stopping the pipeline')
+    pipeline.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mpiapp', description='Pipeline processing of recorded micrographs')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='watch the input directory and process all new micrographs')
+    run_parser.add_argument('--config', help='configuration file like my_config.json')
+    run_parser.add_argument('--input', default='.', help='directory that is watched for new micrographs')
+    run_parser.add_argument('--output', default='output', help='output directory')
+    run_parser.add_argument('--gpus', type=int, nargs='+', help='GPU IDs, overrides the GPUs of the configuration file')
+    run_parser.add_argument('--motioncor', default='motioncor', help='motioncor executable')
+    run_parser.add_argument('--gctf', default='gctf', help='gctf executable')
+    run_parser.add_argument('--files', nargs='*', default=[], help='additional files to process')
+    run_parser.set_defaults(func=run)
+
+    coordinator_parser = subparsers.add_parser('coordinator', help='watch the input directory and send the micrographs to worker agents')
+    coordinator_parser.add_argument('--config', help='configuration file like my_config.json')
+    coordinator_parser.add_argument('--input', default='.', help='directory that is watched for new micrographs')
+    coordinator_parser.add_argument('--output', default='output', help='output directory, shared with the worker agents')
+    coordinator_parser.add_argument('--bind', default='localhost',
+                                    help='address the worker agents connect to, only this computer by default. '
+                                         'The agents are not authenticated, bind only to addresses of a trusted network')
+    coordinator_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port the worker agents connect to')
+    coordinator_parser.add_argument('--files', nargs='*', default=[], help='additional files to process')
+    coordinator_parser.set_defaults(func=coordinator)
+
+    agent_parser = subparsers.add_parser('agent', help='process micrographs of a coordinator on the local GPUs')
+    agent_parser.add_argument('--host', default='localhost', help='host of the coordinator')
+    agent_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port of the coordinator')
+    agent_parser.add_argument('--gpus', type=int, nargs='+', default=[0], help='GPU IDs')
+    agent_parser.add_argument('--slots', type=int, default=1, help='micrographs processed at the same time on each GPU')
+    agent_parser.add_argument('--motioncor', default='motioncor', help='motioncor executable')
+    agent_parser.add_argument('--gctf', default='gctf', help='gctf executable')
+    agent_parser.set_defaults(func=agent)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+Moves the frames of the processed micrographs to the frames directory of the output in the
+background, so the pipeline does not wait for copies of multi-GB stacks. On the same file
+system the frames are renamed, otherwise they are copied in chunks by several threads and
+the original is removed after the copy is complete.
+"""
+import os
+import time
+import errno
+import zlib
+from queue import Queue
+from threading import Thread, Lock, Event
+
+MB = 1024 * 1024
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Bandwidth:
+    """
+    Token bucket that limits the bytes per second of all copies together, so the copies
+    do not slow down the detector that writes the next frames
+    """
+    def __init__(self, bytes_per_second, stop_event):
+        self.rate = bytes_per_second # 0 for no limit
+        self.stop_event = stop_event
+        self.available = 0.0
+        self.last = time.time()
+        self.lock = Lock()
+
+    def consume(self, size):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            # at most one second of unused bandwidth is saved up
+            self.available = min(self.rate, self.available + (now - self.last) * self.rate) - size
+            self.last = now
+            wait = -self.available / self.rate
+        if wait > 0 and self.stop_event.wait(wait):
+            raise Cancelled()
+
+
+class FrameArchiver:
+    """
+    Moves files to the frames directory with a pool of mover threads
+    """
+    def __init__(self, frames_dir, logger, workers=2, copy_threads=4, chunk_size=16 * MB, bandwidth=0, checksum=False):
+        """
+        :param workers: number of files that are moved at the same time
+        :param copy_threads: number of threads that copy the chunks of one file
+        :param chunk_size: bytes that are copied at once, each copy thread keeps one chunk in memory
+        :param bandwidth: bytes per second of all copies together, 0 for no limit
+        :param checksum: compare the checksums of the chunks of the copy with the original before it is removed
+        """
+        self.frames_dir = frames_dir
+        self.logger = logger
+        self.workers = max(1, workers)
+        self.copy_threads = max(1, copy_threads)
+        self.chunk_size = max(MB, chunk_size)
+        self.checksum = checksum
+        self.stop_event = Event()
+        self.bandwidth = Bandwidth(bandwidth, self.stop_event)
+        self.queue = Queue()
+        self.lock = Lock()
+        self.renamed = 0
+        self.copied = 0
+        self.copied_bytes = 0
+        self.copy_time = 0.0
+        self.failed = 0
+
+    @classmethod
+    def from_options(cls, frames_dir, logger, main_options):
+        """
+        Creates the archiver with the settings of the Main options
+        """
+        return cls(frames_dir, logger,
+                   workers=int(main_options.get('archive_workers', 2)),
+                   copy_threads=int(main_options.get('archive_copy_threads', 4)),
+                   chunk_size=int(float(main_options.get('archive_chunk_mb', 16)) * MB),
+                   bandwidth=float(main_options.get('archive_bandwidth_mb', 0)) * MB,
+                   checksum=bool(main_options.get('archive_checksum', False)))
+
+    def start(self):
+        if not os.path.isdir(self.frames_dir):
+            os.mkdir(self.frames_dir)
+        self.threads = [Thread(target=self.worker) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, wait=True):
+        """
+        :param wait: move the files that are still in the queue, otherwise they stay where
+                     they are and running copies are cancelled
+        """
+        if not wait:
+            self.stop_event.set()
+            self.queue.queue.clear()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def move(self, path):
+        """
+        Move the file to the frames directory in the background
+        """
+        self.queue.put(path)
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def worker(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                break
+            try:
+                self.archive(path)
+            except Cancelled:
+                self.logger.debug('Moving {} was cancelled'.format(path))
+            except Exception as ex:
+                with self.lock:
+                    self.failed += 1
+                self.logger.error('Could not move {} to {}: {}'.format(path, self.frames_dir, str(ex)))
+
+    def archive(self, path):
+        destination = os.path.join(self.frames_dir, os.path.basename(path))
+        if os.path.exists(destination):
+            raise OSError(errno.EEXIST, 'The destination already exists', destination)
+        if os.stat(path).st_dev == os.stat(self.frames_dir).st_dev:
+            try:
+                os.rename(path, destination)
+                with self.lock:
+                    self.renamed += 1
+                return
+            except OSError as ex:
+                # e.g. bind mounts of the same file system
+                if ex.errno != errno.EXDEV:
+                    raise
+        start = time.time()
+        size = self.copy(path, destination)
+        os.remove(path)
+        with self.lock:
+            self.copied += 1
+            self.copied_bytes += size
+            self.copy_time += time.time() - start
+
+    def copy(self, path, destination):
+        """
+        Copy the file in chunks with several threads to a temporary file, which is
+        renamed to the destination when the copy is complete
+        :return: size of the file
+        """
+        temporary = destination + '.part'
+        source = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(source).st_size
+            target = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(target, size)
+                offsets = list(range(0, size, self.chunk_size))
+                checksums = self.copy_chunks(source, target, offsets, size)
+                os.fsync(target)
+            finally:
+                os.close(target)
+            if self.checksum:
+                self.verify(temporary, offsets, size, checksums)
+            os.rename(temporary, destination)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        finally:
+            os.close(source)
+        return size
+
+    def copy_chunks(self, source, target, offsets, size):
+        """
+        :return: checksums of the chunks, if they are checked
+        """
+        checksums = {}
+        errors = []
+        next_chunk = iter(offsets)
+        next_lock = Lock()
+
+        def copy_next():
+            try:
+                while not errors:
+                    if self.stop_event.is_set():
+                        raise Cancelled()
+                    with next_lock:
+                        offset = next(next_chunk, None)
+                    if offset is None:
+                        return
+                    length = min(self.chunk_size, size - offset)
+                    self.bandwidth.consume(length)
+                    data = read_range(source, offset, length)
+                    if self.checksum:
+                        checksums[offset] = zlib.crc32(data)
+                    write_range(target, offset, data)
+            except BaseException as ex:
+                errors.append(ex)
+
+        threads = [Thread(target=copy_next) for _ in range(min(self.copy_threads, max(1, len(offsets))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return checksums
+
+    def verify(self, path, offsets, size, checksums):
+        """
+        Read the copy again and compare the checksums of its chunks with the original
+        """
+        target = os.open(path, os.O_RDONLY)
+        try:
+            for offset in offsets:
+                if self.stop_event.is_set():
+                    raise Cancelled()
+                data = read_range(target, offset, min(self.chunk_size, size - offset))
+                if zlib.crc32(data) != checksums[offset]:
+                    raise IOError('The copy differs from the original at byte {}'.format(offset))
+        finally:
+            os.close(target)
+
+    def report(self):
+        with self.lock:
+            report = 'Frames: {} renamed, {} copied'.format(self.renamed, self.copied)
+            if self.copy_time > 0:
+                report += ' with {:.0f} MB/s'.format(self.copied_bytes / MB / self.copy_time)
+            if self.failed:
+                report += ', {} failed'.format(self.failed)
+            return report
+
+
+def read_range(descriptor, offset, length):
+    data = os.pread(descriptor, length, offset)
+    while len(data) < length:
+        # reads of network file systems can return less
+        chunk = os.pread(descriptor, length - len(data), offset + len(data))
+        if not chunk:
+            raise IOError('The file ended before byte {}'.format(offset + length))
+        data += chunk
+    return data
+
+
+def write_range(descriptor, offset, data):
+    view = memoryview(data)
+    written = 0
+    while written < len(data):
+        written += os.pwrite(descriptor, view[written:], offset + written)
@@ -0,0 +1,368 @@
+"""
+Processing on several GPU nodes that share the output directory.
+
+The coordinator watches the input directory and owns the queue, the process table and the ledger.
+Worker agents on the GPU nodes connect to the coordinator over TCP, announce their GPUs, pull
+micrographs and push the results back. The micrographs of an agent that disappears are put back
+in the queue. An agent processes each micrograph with motioncor and then gctf on the same GPU,
+so the gctf batch_size and batch_wait are not used by the agents.
+
+Every message is a json object on a single line:
+    agent -> coordinator: hello, ready (one for each free worker), result, heartbeat
+    coordinator -> agent: welcome (with the options of the coordinator), job
+"""
+import os
+import json
+import socket
+import logging
+import itertools
+from queue import Queue, Empty
+from threading import Thread, Lock, Event, Semaphore
+
+from pipeline import Pipeline, Motioncor, Gctf, Micrograph, GpuScheduler, GpuHealth, process_pool_size, create_process_pool, configure_stages
+
+DEFAULT_PORT = 6543
+HEARTBEAT_INTERVAL = 10 # seconds between two heartbeats of an agent
+HEARTBEAT_TIMEOUT = 60  # an agent that was quiet for this long is considered lost
+
+
+def send_message(connection, lock, message):
+    with lock:
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class Coordinator(Pipeline):
+    """
+    Pipeline that sends the micrographs to worker agents instead of processing them on local GPUs.
+    The post-processing (process table, ledger, moving the frames) is done by the coordinator
+    """
+    def __init__(self, main_options, motioncor_options, gctf_options, input_dir, output_dir,
+                 host='localhost', port=DEFAULT_PORT, logger=None):
+        self.host = host
+        self.port = port
+        self.motioncor_options = motioncor_options
+        self.gctf_options = gctf_options
+        super().__init__(main_options, motioncor_options, gctf_options, input_dir, output_dir, logger=logger)
+
+    def check_input(self, motioncor_executable, gctf_executable):
+        # the GPUs and the executables are on the agents
+        self.check_directories()
+
+    def start_worker_threads(self):
+        """
+        Start the post-processing thread and the server the agents connect to
+        """
+        self.gpu_scheduler = GpuScheduler([], 1)
+        self.gpu_health = GpuHealth([], self.logger) # the agents take care of their GPUs
+        self.motioncor_threads = []
+        self.gctf_threads = []
+        self.postprocessing_threads = [Thread(target=self.postprocessing_worker)]
+        self.agents = []
+        self.agents_lock = Lock()
+        self.job_ids = itertools.count()
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(16)
+        self.server.settimeout(1)
+        self.logger.info('Waiting for worker agents on {}:{}'.format(self.host or '*', self.port))
+
+        self.server_thread = Thread(target=self.serve)
+        for thread in self.postprocessing_threads + [self.server_thread]:
+            thread.daemon = True
+            thread.start()
+
+    def serve(self):
+        while not self.stop_event.is_set():
+            try:
+                connection, address = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            agent = AgentConnection(self, connection, address)
+            with self.agents_lock:
+                self.agents.append(agent)
+            agent.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.server.close()
+        with self.agents_lock:
+            agents = list(self.agents)
+        for agent in agents:
+            agent.close()
+        # no result may come in after the ledger is closed
+        for agent in agents:
+            agent.join()
+        self.server_thread.join()
+        super().stop()
+
+    def status(self):
+        with self.agents_lock:
+            gpus = sum(len(agent.gpus) for agent in self.agents)
+            return 'Processing... ({}, {} agents with {} GPUs)'.format(self.gpu_scheduler.throughput(), len(self.agents), gpus)
+
+
+class AgentConnection:
+    """
+    The connection of the coordinator to one worker agent. Every 'ready' message of the agent
+    allows to send one more micrograph
+    """
+    def __init__(self, coordinator, connection, address):
+        self.coordinator = coordinator
+        self.logger = coordinator.logger
+        self.connection = connection
+        self.name = '{}:{}'.format(*address)
+        self.gpus = []
+        self.send_lock = Lock()
+        self.lock = Lock()
+        self.credits = Semaphore(0)
+        self.in_flight = {} # job id: micrograph
+        self.closed = Event()
+
+    def start(self):
+        self.threads = [Thread(target=self.receive), Thread(target=self.dispatch)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def join(self, timeout=10):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def receive(self):
+        self.connection.settimeout(HEARTBEAT_TIMEOUT)
+        reader = self.connection.makefile('r', encoding='utf-8')
+        try:
+            for line in reader:
+                message = json.loads(line)
+                if message['type'] == 'hello':
+                    self.name = '{} ({})'.format(message['host'], self.name)
+                    self.gpus = message['gpus']
+                    self.logger.info('Worker agent {} connected with GPUs {}'.format(self.name, self.gpus))
+                    send_message(self.connection, self.send_lock, {
+                        'type': 'welcome',
+                        'output_dir': self.coordinator.output_dir,
+                        'main': self.coordinator.main_options,
+                        'motioncor': self.coordinator.motioncor_options,
+                        'gctf': self.coordinator.gctf_options,
+                    })
+                elif message['type'] == 'ready':
+                    self.credits.release()
+                elif message['type'] == 'result':
+                    self.result(message)
+        except (OSError, ValueError, KeyError) as ex:
+            if not self.closed.is_set():
+                self.logger.warning('Lost connection to worker agent {}: {}'.format(self.name, str(ex)))
+        self.close()
+
+    def result(self, message):
+        with self.lock:
+            micrograph = self.in_flight.pop(message['id'], None)
+        if micrograph is None or self.coordinator.stop_event.is_set():
+            return # late results are dropped, the micrograph is processed again after a restart
+        ignored = micrograph.update_from_dict(message['micrograph'], self.coordinator.output_dir)
+        if ignored:
+            self.logger.warning('Ignored the files {} of worker agent {} for micrograph {}, they are not in the output directory'.format(
+                ', '.join(ignored), self.name, micrograph.basename))
+        self.logger.debug('Worker agent {} finished micrograph {}'.format(self.name, micrograph.basename))
+        if 'gctf_ctf_fit' in micrograph.files:
+            self.coordinator.ledger.record(micrograph, 'gctf')
+        elif 'gctf_input' in micrograph.files:
+            self.coordinator.ledger.record(micrograph, 'motioncor')
+        # give a micrograph that failed another chance, possibly on another agent
+        if 'gctf_ctf_fit' not in micrograph.files and self.coordinator.retry(micrograph, self.name, self.coordinator.queue.put):
+            return
+        # only aligned micrographs go on, like in the pipeline
+        if 'gctf_input' in micrograph.files:
+            self.coordinator.pass_to_next_stage(self.coordinator.postprocessing_queue, micrograph)
+
+    def dispatch(self):
+        queue = self.coordinator.queue
+        while not self.closed.is_set() and not self.coordinator.stop_event.is_set():
+            if not self.credits.acquire(timeout=1):
+                continue
+
+            micrograph = None
+            while micrograph is None and not self.closed.is_set():
+                try:
+                    micrograph = queue.get(timeout=1)
+                except Empty:
+                    continue
+                if micrograph is None:
+                    return # the coordinator stops
+
+            if micrograph is None:
+                break
+
+            # continue after the last stage that was completed before a restart
+            try:
+                stage = self.coordinator.resume(micrograph)
+            except Exception as ex:
+                self.logger.error(str(ex))
+                stage = 'done'
+            if stage == 'gctf':
+                self.coordinator.pass_to_next_stage(self.coordinator.postprocessing_queue, micrograph)
+            if stage in ('done', 'gctf'):
+                self.credits.release()
+                continue
+
+            job_id = next(self.coordinator.job_ids)
+            with self.lock:
+                if self.closed.is_set():
+                    queue.put(micrograph)
+                    break
+                self.in_flight[job_id] = micrograph
+            try:
+                send_message(self.connection, self.send_lock, {'type': 'job', 'id': job_id, 'micrograph': micrograph.to_dict()})
+                self.logger.debug('Sent micrograph {} to worker agent {}'.format(micrograph.basename, self.name))
+            except OSError:
+                self.close()
+
+    def close(self):
+        """
+        Close the connection and put the micrographs of the agent back in the queue
+        """
+        with self.lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+            micrographs = list(self.in_flight.values())
+            self.in_flight.clear()
+        try:
+            # wakes up the receiving thread
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+
+        if not self.coordinator.stop_event.is_set():
+            for micrograph in micrographs:
+                self.logger.warning('Putting micrograph {} of worker agent {} back in the queue'.format(micrograph.basename, self.name))
+                self.coordinator.queue.put(micrograph)
+        with self.coordinator.agents_lock:
+            if self in self.coordinator.agents:
+                self.coordinator.agents.remove(self)
+        self.logger.info('Worker agent {} disconnected'.format(self.name))
+
+
+class Agent:
+    """
+    Worker agent that processes the micrographs of a coordinator on the local GPUs.
+    The output directory of the coordinator must be available under the same path.
+    Each micrograph is processed with motioncor and then gctf on the same GPU, without gctf batches
+    """
+    def __init__(self, host, port, gpus, motioncor_executable='motioncor', gctf_executable='gctf', slots=1, logger=None):
+        self.host = host
+        self.port = port
+        self.gpus = gpus
+        self.slots = slots
+        self.motioncor_executable = motioncor_executable
+        self.gctf_executable = gctf_executable
+        self.logger = logger or logging.getLogger('mpiapp')
+        self.stop_event = Event()
+        self.send_lock = Lock()
+        self.jobs = Queue()
+
+    def send(self, message):
+        send_message(self.connection, self.send_lock, message)
+
+    def run(self):
+        """
+        Connect to the coordinator and process micrographs until the connection is closed
+        """
+        self.connection = socket.create_connection((self.host, self.port))
+        reader = self.connection.makefile('r', encoding='utf-8')
+        self.send({'type': 'hello', 'host': socket.gethostname(), 'gpus': self.gpus})
+        welcome = json.loads(reader.readline())
+        self.logger.info('Connected to coordinator {}:{}, output directory {}'.format(self.host, self.port, welcome['output_dir']))
+
+        self.motioncor = Motioncor(self.logger, welcome['motioncor'], welcome['output_dir'], self.motioncor_executable)
+        self.gctf = Gctf(self.logger, welcome['gctf'], welcome['output_dir'], self.gctf_executable)
+        configure_stages(welcome['main'], self.motioncor, self.gctf)
+        self.executor = create_process_pool(process_pool_size(welcome['main'], len(self.gpus) * self.slots))
+        self.motioncor.executor = self.executor
+        self.gctf.executor = self.executor
+        self.gpu_health = GpuHealth.from_options(self.gpus, self.logger, welcome['main'])
+        if self.gctf.batch_size > 1:
+            self.logger.info('Gctf batches are not used by worker agents, each micrograph is processed on its own')
+        self.failed = set() # (micrograph, GPU) pairs that failed
+
+        threads = [Thread(target=self.worker, args=(i,)) for i in self.gpus for _ in range(self.slots)]
+        threads.append(Thread(target=self.heartbeat))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for line in reader:
+                message = json.loads(line)
+                if message['type'] == 'job':
+                    self.jobs.put(message)
+        except OSError as ex:
+            self.logger.error('Lost connection to coordinator: {}'.format(str(ex)))
+        self.logger.info('Coordinator closed the connection')
+
+        self.stop_event.set()
+        # the results could not be sent anymore
+        self.motioncor.abort()
+        self.gctf.abort()
+        for thread in threads:
+            self.jobs.put(None)
+        self.executor.shutdown(wait=False)
+        for timeouts in (self.motioncor.timeouts, self.gctf.timeouts):
+            self.logger.info('Timeout of ' + timeouts.report())
+        for line in self.gpu_health.report():
+            self.logger.info(line)
+
+    def heartbeat(self):
+        while not self.stop_event.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.send({'type': 'heartbeat'})
+            except OSError:
+                break
+
+    def worker(self, gpu_id):
+        while not self.stop_event.is_set():
+            # no new micrographs while the GPU is quarantined
+            if not self.gpu_health.acquire(gpu_id):
+                self.stop_event.wait(1)
+                continue
+            try:
+                self.send({'type': 'ready'})
+            except OSError:
+                break
+            message = self.jobs.get()
+            if message is None:
+                break
+            micrograph = Micrograph(message['micrograph']['abspath'], self.logger, source=message['micrograph']['source'])
+            micrograph.update_from_dict(message['micrograph'], self.motioncor.output_dir)
+            try:
+                # micrographs that were aligned before a restart of the coordinator only need gctf
+                if not os.path.isfile(micrograph.files.get('gctf_input', '')):
+                    self.motioncor(micrograph, gpu_id)
+                if 'gctf_input' in micrograph.files:
+                    self.gctf(micrograph, gpu_id)
+            except Exception as ex:
+                self.logger.error(str(ex))
+            if 'gctf_ctf_fit' in micrograph.files:
+                self.gpu_health.success(gpu_id)
+            elif self.stop_event.is_set():
+                break # aborted, which is not a failure of the GPU
+            elif (micrograph.abspath, gpu_id) not in self.failed:
+                # the coordinator sends a failed micrograph back, if there is no other agent.
+                # Only its first failure on a GPU counts against the GPU
+                self.failed.add((micrograph.abspath, gpu_id))
+                self.gpu_health.failure(gpu_id, 'motioncor' if 'gctf_input' not in micrograph.files else 'gctf')
+            else:
+                self.gpu_health.release(gpu_id)
+            micrograph.collect_pending()
+            try:
+                self.send({'type': 'result', 'id': message['id'], 'micrograph': micrograph.to_dict()})
+            except OSError:
+                break
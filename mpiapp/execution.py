@@ -0,0 +1,136 @@
+"""
+Runs the GPU programs. The stdout of the program is written to its log file
+while it runs and scanned for error markers, the stderr is kept for the log
+messages. Both pipes are read all the time, so a program with a lot of output
+can not block on a full pipe until its timeout expires.
+Each program runs in its own process group, so a kill also reaches the children
+of wrapper scripts, which would otherwise keep the pipes open.
+"""
+import os
+import time
+import signal
+import subprocess
+from threading import Thread, Lock
+
+STDERR_LIMIT = 64 * 1024 # bytes of stderr that are kept
+
+
+class ProcessResult:
+    def __init__(self, returncode, stderr, errors, timed_out, runtime, aborted=False):
+        self.returncode = returncode # negative if the process was killed, None if it was not started
+        self.stderr = stderr        # decoded stderr, at most STDERR_LIMIT bytes
+        self.errors = errors        # lines of stdout and stderr with an error marker
+        self.timed_out = timed_out  # the process was killed after the timeout
+        self.runtime = runtime
+        self.aborted = aborted      # the process was killed or not started, because the stage was aborted
+
+    @property
+    def ok(self):
+        return not (self.timed_out or self.aborted or self.returncode != 0 or self.stderr or self.errors)
+
+
+class ProcessRegistry:
+    """
+    The processes that were started by a stage, so that an abort only kills our own processes.
+    After an abort no more processes are started
+    """
+    def __init__(self):
+        self.processes = set()
+        self.closed = False
+        self.lock = Lock()
+
+    def add(self, process):
+        """
+        :return: False if the stage was aborted, then the process has to be killed
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            self.processes.add(process)
+            return True
+
+    def remove(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def kill_all(self):
+        with self.lock:
+            self.closed = True
+            processes = list(self.processes)
+        for process in processes:
+            kill(process)
+
+
+def kill(process):
+    """
+    Kill the process and the other processes of its process group
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            process.kill()
+        except OSError:
+            pass # already finished
+
+
+def run(cmd, log_file, timeout=None, error_markers=(), registry=None):
+    """
+    Run the command and write its stdout to the log file
+    :param cmd: list with the executable and its arguments
+    :param log_file: file the stdout is written to
+    :param timeout: seconds until the process is killed, None to wait forever
+    :param error_markers: strings that mark an error in a line of stdout or stderr, like 'Segmentation fault'
+    :param registry: ProcessRegistry the process is added to while it runs
+    :return: ProcessResult, which is aborted without running the command if the registry was closed
+    """
+    if registry is not None and registry.closed:
+        return ProcessResult(None, '', [], False, 0.0, aborted=True)
+    errors = []
+    stderr = bytearray()
+    markers = [marker.encode('utf-8') for marker in error_markers]
+
+    def scan(line):
+        if any(marker in line for marker in markers):
+            errors.append(line.decode('utf-8', 'replace').rstrip())
+
+    def read_stdout(pipe, log):
+        for line in iter(pipe.readline, b''):
+            log.write(line)
+            scan(line)
+        pipe.close()
+
+    def read_stderr(pipe):
+        for line in iter(pipe.readline, b''):
+            if len(stderr) < STDERR_LIMIT:
+                stderr.extend(line[:STDERR_LIMIT - len(stderr)])
+            scan(line)
+        pipe.close()
+
+    start = time.time()
+    with open(log_file, 'wb') as log:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        if registry is not None and not registry.add(process):
+            kill(process) # aborted while it was started
+        readers = [Thread(target=read_stdout, args=(process.stdout, log)),
+                   Thread(target=read_stderr, args=(process.stderr,))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        timed_out = False
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            kill(process)
+            process.wait()
+        finally:
+            if registry is not None:
+                registry.remove(process)
+        aborted = registry is not None and registry.closed and process.returncode != 0
+        for reader in readers:
+            # children of a killed process might keep the pipes open
+            reader.join(5 if timed_out or aborted or process.returncode < 0 else None)
+
+    return ProcessResult(process.returncode, stderr.decode('utf-8', 'replace'), errors, timed_out, time.time() - start, aborted)
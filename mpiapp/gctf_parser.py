@@ -0,0 +1,112 @@
+"""
+Parsers for the output of gctf: the stdout, the _EPA.log file and the star file written with --ctfstar.
+Every file is read in a single forward pass.
+"""
+import os
+
+import numpy as np
+
+FINAL_VALUES = 'Final Values'
+# columns of the _EPA.log file
+EPA_COLUMNS = ('Resolution', '|CTFsim|', 'EPA( Ln|F| )', 'EPA(Ln|F| - Bg)', 'CCC')
+
+
+def parse_output(log, gctf_inputs):
+    """
+    Split the stdout of a gctf run over several input files into one part per file
+    and read the final values of the CTF fit of each part.
+    Gctf processes the files in the order they were given, so a part starts where
+    its input file is mentioned first. If the file names can not be found, the
+    output is split after the 'Final Values' lines.
+    :param log: gctf stdout, a string or an iterable of lines like an open file
+    :param gctf_inputs: list of the input files given to gctf
+    :return: list with the log and the final values of each input file or None,
+             if not all files have final values
+    """
+    names = [os.path.basename(gctf_input) for gctf_input in gctf_inputs]
+    by_name = [[]]          # parts that start with the first line mentioning their file
+    by_name_values = [None]
+    by_final = [[]]         # parts that end with a 'Final Values' line
+    final_values = []
+    previous = ''
+    lines = log.split('\n') if isinstance(log, str) else (line.rstrip('\n') for line in log)
+    for line in lines:
+        if len(by_name) < len(names) and names[len(by_name)] in line:
+            by_name.append([])
+            by_name_values.append(None)
+        by_name[-1].append(line)
+        by_final[-1].append(line)
+        if line.endswith(FINAL_VALUES):
+            # the line above the values has the names of the values, the last final values of a part count
+            values = parse_final_values(previous, line)
+            by_name_values[-1] = values
+            final_values.append(values)
+            by_final.append([])
+        previous = line
+
+    if len(by_name) == len(names) and all(values is not None for values in by_name_values):
+        parts, values = by_name, by_name_values
+    elif len(final_values) == len(names) and names:
+        # the lines after the last final values belong to the last file
+        by_final[-2].extend(by_final.pop())
+        parts, values = by_final, final_values
+    else:
+        return None
+    return [('\n'.join(part), part_values) for part, part_values in zip(parts, values)]
+
+
+def parse_final_values(keys_line, values_line):
+    """
+    :param keys_line: line with the names of the values, like 'Defocus_U   Defocus_V       Angle         CCC'
+    :param values_line: line with the values, like '21000.00    20000.00       10.00    0.100000  Final Values'
+    :return: dictionary with the values
+    """
+    values = [float(value) for value in values_line.split()[:-2]]
+    return dict(zip(keys_line.split(), values))
+
+
+def read_epa_log(epa_log):
+    """
+    :param epa_log: _EPA.log file of gctf, a header line and one line for each resolution
+    :return: array with one row for each resolution and the EPA_COLUMNS
+    """
+    return np.loadtxt(epa_log, skiprows=1, ndmin=2)
+
+
+def resolution_at_cutoff(epa, cc_cutoff):
+    """
+    :param epa: array of read_epa_log
+    :return: the first resolution at which the cross correlation falls below the cutoff,
+             or the last resolution, if it never does
+    """
+    below = epa[:, EPA_COLUMNS.index('CCC')] < cc_cutoff
+    index = np.argmax(below) if below.any() else len(below) - 1
+    return float(epa[index, EPA_COLUMNS.index('Resolution')])
+
+
+def read_star_file(star_file, gctf_inputs):
+    """
+    Read the columns and the rows of the gctf star file
+    :param star_file: star file written by gctf with the --ctfstar option
+    :param gctf_inputs: list of the input files given to gctf
+    :return: list of columns and one row for each input file, in the same order
+    """
+    columns = []
+    rows = []
+    with open(star_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('_'):
+                columns.append(line)
+            elif line:
+                row = line.split()
+                if len(row) == len(columns):
+                    rows.append(row)
+
+    # gctf writes the name of the micrograph in the first column
+    rows_by_name = {os.path.basename(row[0]): row for row in rows}
+    names = [os.path.basename(gctf_input) for gctf_input in gctf_inputs]
+    if all(name in rows_by_name for name in names):
+        return columns, [rows_by_name[name] for name in names]
+    # otherwise the rows belong to the last micrographs that were written
+    return columns, rows[-len(gctf_inputs):]
@@ -0,0 +1,229 @@
+"""
+Reads the headers of the frame files to find out if they were written completely
+and if they fit to the other frame files of the session.
+MRC headers declare the size of the stack, TIFF files are complete when their chain
+of image directories and all strips of the images are inside the file.
+"""
+import os
+import struct
+
+import numpy as np
+
+COMPLETE = 'complete'       # the file has the size its header declares
+INCOMPLETE = 'incomplete'   # the file is smaller than its header declares
+UNKNOWN = 'unknown'         # the header does not tell the size of the file
+MISSING = 'missing'         # the file does not exist (anymore)
+
+MRC_EXTENSIONS = ('.mrc', '.mrcs')
+TIFF_EXTENSIONS = ('.tif', '.tiff', '.eer', '.gain')
+MRC_HEADER_SIZE = 1024
+# bytes per pixel of the MRC modes, mode 101 has 4 bit per pixel
+MRC_MODE_BYTES = {0: 1, 1: 2, 2: 4, 3: 4, 4: 8, 6: 2, 12: 2}
+MRC_MODE_TYPES = {0: 'int8', 1: 'int16', 2: 'float32', 3: 'complex int16', 4: 'complex64',
+                  6: 'uint16', 12: 'float16', 101: 'uint4'}
+TIFF_MAX_IMAGES = 100000 # more image directories are a broken chain
+# tags with the offsets and the byte counts of the image data
+TIFF_DATA_TAGS = ((273, 279), (324, 325)) # StripOffsets, StripByteCounts and TileOffsets, TileByteCounts
+TIFF_PAGE_NUMBER = 297
+TIFF_WIDTH, TIFF_HEIGHT, TIFF_BITS, TIFF_SAMPLE_FORMAT = 256, 257, 258, 339
+TIFF_SAMPLE_FORMATS = {1: 'uint', 2: 'int', 3: 'float'}
+TIFF_TYPES = {3: 'u2', 4: 'u4'} # SHORT and LONG
+
+
+class Readiness:
+    def __init__(self, state, size, expected=None, pages=None, width=None, height=None, pixel_type=None):
+        self.state = state
+        self.size = size            # bytes on disk
+        self.expected = expected    # bytes the header declares, None if not known
+        self.pages = pages          # images in the file, None if not known
+        self.width = width          # pixels of the images, None if not known
+        self.height = height
+        self.pixel_type = pixel_type # like 'int8' or 'float32', None if not known
+
+    def describe(self):
+        """
+        :return: the dimensions of the images, like '40 frames of 4096 x 4096 int8'
+        """
+        return '{} frames of {} x {} {}'.format(self.pages, self.width, self.height, self.pixel_type)
+
+    def __str__(self):
+        if self.expected is None:
+            return '{}, {} bytes'.format(self.state, self.size)
+        return '{}, {} of {} bytes'.format(self.state, self.size, self.expected)
+
+
+def check_file(path):
+    """
+    :return: Readiness of the file
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            extension = os.path.splitext(path)[1].lower()
+            if extension in MRC_EXTENSIONS:
+                return check_mrc(f, size)
+            if extension in TIFF_EXTENSIONS:
+                return check_tiff(f, size)
+            return Readiness(UNKNOWN, size)
+    except OSError:
+        return Readiness(MISSING, 0)
+
+
+def mrc_header(header):
+    """
+    :param header: the first MRC_HEADER_SIZE bytes of an MRC file
+    :return: nx, ny, nz, mode and the size of the extended header, or None if it is not an MRC header
+    """
+    # the machine stamp tells the byte order, 0x11 for big endian
+    order = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(order + '4i', header[:16])
+    extended = struct.unpack(order + 'i', header[92:96])[0]
+    if min(nx, ny, nz) <= 0 or extended < 0 or (mode not in MRC_MODE_BYTES and mode != 101):
+        return None
+    return nx, ny, nz, mode, extended
+
+
+def check_mrc(f, size):
+    header = f.read(MRC_HEADER_SIZE)
+    if len(header) < MRC_HEADER_SIZE:
+        return Readiness(INCOMPLETE, size)
+    values = mrc_header(header)
+    if values is None:
+        return Readiness(UNKNOWN, size)
+    nx, ny, nz, mode, extended = values
+    if mode == 101:
+        data = (nx + 1) // 2 * ny * nz
+    else:
+        data = nx * ny * nz * MRC_MODE_BYTES[mode]
+    expected = MRC_HEADER_SIZE + extended + data
+    return Readiness(COMPLETE if size >= expected else INCOMPLETE, size, expected,
+                     pages=nz, width=nx, height=ny, pixel_type=MRC_MODE_TYPES[mode])
+
+
+def read_tiff_values(f, order, field_type, count, value):
+    """
+    :param value: the 4 bytes of the directory entry, which are the values or the offset of the values
+    :return: array of the values, or None if they are not inside the file
+    """
+    if field_type not in TIFF_TYPES:
+        return None
+    dtype = np.dtype(order + TIFF_TYPES[field_type])
+    length = dtype.itemsize * count
+    if length > 4:
+        f.seek(struct.unpack(order + 'I', value)[0])
+        data = f.read(length)
+        if len(data) < length:
+            return None
+    else:
+        data = value[:length]
+    return np.frombuffer(data, dtype)
+
+
+def check_tiff(f, size):
+    """
+    Follow the chain of the image directories. The writer might append more images
+    to a chain that looks complete, so the file is only complete if the first image
+    directory has the number of pages
+    """
+    head = f.read(8)
+    if len(head) < 8:
+        return Readiness(INCOMPLETE, size)
+    if head[:2] not in (b'II', b'MM'):
+        return Readiness(UNKNOWN, size)
+    order = '<' if head[:2] == b'II' else '>'
+    version, offset = struct.unpack(order + 'HI', head[2:])
+    if version != 42:
+        return Readiness(UNKNOWN, size) # BigTIFF
+
+    end = 8     # end of the last byte that belongs to the images
+    images = 0
+    pages = None
+    image = {}  # dimensions of the first image
+    visited = set()
+    while offset:
+        if offset in visited or images >= TIFF_MAX_IMAGES:
+            return Readiness(UNKNOWN, size)
+        visited.add(offset)
+        f.seek(offset)
+        data = f.read(2)
+        if len(data) < 2:
+            return Readiness(INCOMPLETE, size, max(end, offset + 2))
+        count = struct.unpack(order + 'H', data)[0]
+        entries = f.read(12 * count + 4)
+        if len(entries) < 12 * count + 4:
+            return Readiness(INCOMPLETE, size, max(end, offset + 2 + 12 * count + 4))
+        end = max(end, offset + 2 + 12 * count + 4)
+
+        tags = {}
+        for index in range(count):
+            tag, field_type, values, value = struct.unpack(order + 'HHI4s', entries[12 * index:12 * index + 12])
+            tags[tag] = (field_type, values, value)
+        for offsets_tag, counts_tag in TIFF_DATA_TAGS:
+            if offsets_tag in tags and counts_tag in tags:
+                offsets = read_tiff_values(f, order, *tags[offsets_tag])
+                counts = read_tiff_values(f, order, *tags[counts_tag])
+                if offsets is None or counts is None:
+                    return Readiness(INCOMPLETE, size, end)
+                if len(offsets) and len(offsets) == len(counts):
+                    end = max(end, int((offsets.astype(np.int64) + counts).max()))
+        if images == 0:
+            if TIFF_PAGE_NUMBER in tags:
+                page_numbers = read_tiff_values(f, order, *tags[TIFF_PAGE_NUMBER])
+                if page_numbers is not None and len(page_numbers) == 2 and page_numbers[1] > 0:
+                    pages = int(page_numbers[1])
+            image = tiff_image(f, order, tags)
+
+        images += 1
+        offset = struct.unpack(order + 'I', entries[-4:])[0]
+        if offset >= size:
+            return Readiness(INCOMPLETE, size, max(end, offset + 2))
+
+    if end > size or (pages is not None and images < pages):
+        return Readiness(INCOMPLETE, size, end if end > size else None, pages, **image)
+    return Readiness(COMPLETE if pages is not None else UNKNOWN, size, end, images, **image)
+
+
+def tiff_image(f, order, tags):
+    """
+    :param tags: the entries of an image directory
+    :return: dict with the width, the height and the pixel type of the image
+    """
+    values = {}
+    for key, tag in (('width', TIFF_WIDTH), ('height', TIFF_HEIGHT), ('bits', TIFF_BITS), ('format', TIFF_SAMPLE_FORMAT)):
+        if tag in tags:
+            value = read_tiff_values(f, order, *tags[tag])
+            if value is not None and len(value):
+                values[key] = int(value[0])
+    image = {'width': values.get('width'), 'height': values.get('height')}
+    if 'bits' in values:
+        image['pixel_type'] = TIFF_SAMPLE_FORMATS.get(values.get('format', 1), 'uint') + str(values['bits'])
+    return image
+
+
+def validate_header(readiness, reference=None, gain=None):
+    """
+    Check the dimensions of a complete frame file, before it is sent to a GPU
+    :param reference: Readiness of the first frame file of the session, which has to
+                      have the same dimensions, pixel type and number of frames
+    :param gain: Readiness of the gain reference, which has the size of the frames,
+                 it may be rotated by 90 degrees
+    :return: list of the problems, empty if the file fits
+    """
+    problems = []
+    if readiness.width is None or readiness.height is None:
+        return problems # the header does not tell
+    if readiness.pages is not None and readiness.pages < 1:
+        problems.append('it has no frames')
+    if gain is not None and gain.width is not None and \
+            (readiness.width, readiness.height) not in ((gain.width, gain.height), (gain.height, gain.width)):
+        problems.append('its frames are {} x {}, but the gain reference is {} x {}'.format(
+            readiness.width, readiness.height, gain.width, gain.height))
+    if reference is not None:
+        for name, value, expected in (('size', (readiness.width, readiness.height), (reference.width, reference.height)),
+                                      ('pixel type', readiness.pixel_type, reference.pixel_type),
+                                      ('number of frames', readiness.pages, reference.pages)):
+            if value != expected:
+                problems.append('its {} differs from the first micrograph: {} instead of {}'.format(
+                    name, readiness.describe(), reference.describe()))
+                break
+    return problems
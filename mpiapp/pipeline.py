@@ -0,0 +1,1821 @@
+import os
+import shutil
+import logging
+import json
+import re
+import warnings
+import time
+import heapq
+import itertools
+import sqlite3
+import signal
+import multiprocessing
+# import for event handling
+# imports for data processing and analysis
+import numpy as np
+import pandas as pd
+# imports for multi-threading
+from queue import Queue, Full, Empty
+from collections import deque
+from threading import Thread, Lock, Event, Condition, BoundedSemaphore
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+# imports for image cropping
+import mrcfile
+
+import execution
+from gctf_parser import parse_output, read_epa_log, resolution_at_cutoff, read_star_file
+from spectrum import create_power_spectrum
+from watcher import create_watcher, select_watcher
+from archiver import FrameArchiver
+from headers import check_file, validate_header, COMPLETE, INCOMPLETE
+
+BASE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'base_config.json')
+MOTIONCOR_ESSENTIAL_KEYS = ['timeout', 'trials', 'kV', 'PixSize', 'FmDose'] #optionally also: 'Gain'
+MOTIONCOR_ERROR_MARKERS = ['Segmentation fault', 'CUDA error', 'out of memory']
+GCTF_ERROR_MARKERS = ['Segmentation fault', 'CUDA error', 'out of memory']
+GCTF_ESSENTIAL_KEYS = ['timeout', 'trials', 'cc_cutoff', 'apix', 'kV', 'ac', 'cs', 'batch_size', 'batch_wait']
+# options of motioncor and gctf that follow from the Main options
+MAIN_TO_MOTIONCOR = {'kV': 'kV', 'apix': 'PixSize', 'dose_per_frame': 'FmDose'}
+MAIN_TO_GCTF = {'kV': 'kV', 'apix': 'apix', 'cs': 'cs', 'ac': 'ac'}
+
+
+def load_config(filename=None):
+    """
+    Loads the options of a configuration file like my_config.json.
+    Essential options that are not in the file are taken from base_config.json
+    :param filename: json file with the sections "Main", "Motioncor" and "Gctf"
+    :return: dictionaries with the main, motioncor and gctf options
+    """
+    base_config = json.load(open(BASE_CONFIG))
+    config = json.load(open(filename)) if filename else {}
+
+    main_options = base_config["Main"]
+    main_options.update(config.get("Main", {}))
+
+    # the options in the motioncor and gctf sections win over the ones that follow from the Main options
+    motioncor_options = dict(config.get("Motioncor", {}))
+    gctf_options = dict(config.get("Gctf", {}))
+    motioncor_derived, gctf_derived = derive_stage_options(main_options, motioncor_options.get('FtBin', base_config["Motioncor"]['FtBin']))
+    for options, derived in ((motioncor_options, motioncor_derived), (gctf_options, gctf_derived)):
+        for key, value in derived.items():
+            options.setdefault(key, value)
+
+    for key in MOTIONCOR_ESSENTIAL_KEYS:
+        if key not in motioncor_options:
+            motioncor_options[key] = base_config["Motioncor"][key]
+    if main_options['file_extension'] == 'tif':
+        motioncor_options['InTiff'] = '{motioncor_input}'
+    else:
+        motioncor_options['InMrc'] = '{motioncor_input}'
+    if 'Gain' not in motioncor_options and main_options.get('Gain'):
+        motioncor_options['Gain'] = main_options['Gain']
+
+    for key in GCTF_ESSENTIAL_KEYS:
+        if key not in gctf_options:
+            gctf_options[key] = base_config["Gctf"][key]
+
+    return main_options, motioncor_options, gctf_options
+
+
+def derive_stage_options(main_options, ftbin):
+    """
+    The motioncor and gctf options that follow from the Main options, like the acceleration voltage.
+    Gctf gets the pixel size of the aligned micrographs, which motioncor binned by FtBin.
+    Values that are not numbers, like a line of the GUI that is being edited, are taken as they are
+    :param main_options: dictionary with some or all of the Main options
+    :param ftbin: binning of motioncor
+    :return: dictionaries with the motioncor and gctf options
+    """
+    motioncor_options = {MAIN_TO_MOTIONCOR[key]: value for key, value in main_options.items() if key in MAIN_TO_MOTIONCOR}
+    gctf_options = {MAIN_TO_GCTF[key]: value for key, value in main_options.items() if key in MAIN_TO_GCTF}
+    if 'apix' in gctf_options:
+        try:
+            gctf_options['apix'] = float(gctf_options['apix']) * float(ftbin)
+        except ValueError:
+            pass
+    return motioncor_options, gctf_options
+
+def start_logging(logger, output_dir):
+    """
+    Start logging to 'mpiapp.log' inside the output directory
+    If there is already a file handler, do nothing
+    """
+    if not logger.handlers:
+
+        # set up logger
+        logger.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+        # logging to file
+        fh = logging.FileHandler(os.path.join(output_dir, 'mpiapp.log'))
+        # FIXME change to INFO
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(formatter)
+
+        # logging to console
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(formatter)
+
+        logger.addHandler(fh)
+        logger.addHandler(ch)
+
+
+class Pipeline:
+    """
+    Processes the micrographs of the input directory with motioncor and gctf.
+    The pipeline does not depend on the GUI, it is used by the MPIApp and by
+    the command line interface (python -m mpiapp run)
+    """
+    def __init__(self, main_options, motioncor_options, gctf_options, input_dir, output_dir,
+                 motioncor_executable='motioncor', gctf_executable='gctf', logger=None):
+        self.main_options = main_options
+        self.logger = logger or logging.getLogger('mpiapp')
+        self.file_extension = '.' + main_options['file_extension']
+        self.input_dir = input_dir
+        # work with absolute paths, or symlinks will not work
+        self.output_dir = os.path.abspath(output_dir)
+        self.check_input(motioncor_executable, gctf_executable)
+
+        self.motioncor = Motioncor(self.logger, motioncor_options, self.output_dir, motioncor_executable)
+        self.gctf = Gctf(self.logger, gctf_options, self.output_dir, gctf_executable)
+        configure_stages(main_options, self.motioncor, self.gctf)
+
+    def check_input(self, motioncor_executable, gctf_executable):
+        if len(self.main_options['GPUs']) == 0:
+            raise ValueError('You must select at least one GPU')
+        assert shutil.which(motioncor_executable), "Select a motioncor executable"
+        assert shutil.which(gctf_executable), "Select a gctf executable"
+        self.check_directories()
+
+    def check_directories(self):
+        if self.main_options.get('queue_policy', 'fifo') not in MicrographQueue.policies:
+            raise ValueError('Unknown queue policy {}, use one of: {}'.format(self.main_options['queue_policy'], ', '.join(MicrographQueue.policies)))
+        select_watcher(self.main_options.get('watcher', 'auto'), self.input_dir)
+        if not os.path.isdir(self.input_dir):
+            raise ValueError('The input directory does not exist')
+        # creates at maximum one subfolder to an existing directory as output directory
+        if not os.path.isdir(self.output_dir):
+            try:
+                os.mkdir(self.output_dir)
+            except Exception as ex:
+                raise type(ex)(str(ex) + '(Output Directory)')
+
+    def start(self):
+        # reset the stop event in case we did an abort before
+        self.stop_event = Event()
+
+        # start everything
+        start_logging(self.logger, self.output_dir)
+        self.start_process_queue()
+        self.start_ledger()
+        self.start_process_pool()
+        self.start_archiver()
+        self.start_event_notifier()
+        self.start_worker_threads()
+        self.start_writer_thread()
+
+    def add_files(self, files, source='manual'):
+        """
+        Put files in the queue that are not in the input directory
+        """
+        for item in files:
+            if not item.endswith(self.file_extension):
+                self.logger.warning('Wrong input file type: {}'.format(item))
+                continue
+            readiness = check_file(item)
+            if readiness.state == INCOMPLETE:
+                self.logger.error('{} is truncated ({}), it is not processed'.format(item, readiness))
+                self.truncated_file(item, readiness)
+            else:
+                self.new_file(item, source)
+
+    def new_file(self, path, source='watch'):
+        """
+        Put the file in the queue, unless it was put there before. A file can be
+        found by the scan of the input directory, by its events and in the file list.
+        Files with other dimensions than the gain reference or the first micrograph
+        are rejected, before they fail on a GPU
+        """
+        path = os.path.abspath(path)
+        with self.files_lock:
+            if path in self.files:
+                return
+            self.files.add(path)
+            self.truncated.discard(path) # it was completed after all
+        readiness = check_file(path)
+        if self.main_options.get('validate_headers', True):
+            problems = self.validate(readiness)
+            if problems:
+                self.logger.error('Micrograph {} is rejected, {}'.format(path, '; '.join(problems)))
+                with self.files_lock:
+                    self.rejected.add(path)
+                return
+        self.logger.debug('New micrograph: {}. Inserting in queue.'.format(path))
+        micrograph = Micrograph(path, self.logger, source=source)
+        micrograph.frames, micrograph.width, micrograph.height = readiness.pages, readiness.width, readiness.height
+        self.queue.put(micrograph)
+
+    def validate(self, readiness):
+        """
+        Check the header of a new file against the gain reference and the first micrograph.
+        The first file that fits the gain reference is the reference for the others
+        :return: list of the problems, empty if the file fits
+        """
+        with self.files_lock:
+            problems = validate_header(readiness, self.reference_header, self.gain_header)
+            if not problems and self.reference_header is None and readiness.width is not None:
+                self.reference_header = readiness
+                self.logger.info('The micrographs have {}'.format(readiness.describe()))
+        return problems
+
+    def read_gain_header(self):
+        """
+        :return: Readiness of the gain reference, None if there is none or its header can not be read
+        """
+        gain = self.motioncor.options.get('Gain')
+        if not gain:
+            return None
+        readiness = check_file(gain)
+        if readiness.state != COMPLETE or readiness.width is None:
+            self.logger.warning('Could not read the size of the gain reference {}, the frames are not checked against it'.format(gain))
+            return None
+        return readiness
+
+    def truncated_file(self, path, readiness):
+        """
+        The file is smaller than its header declares and its size did not change,
+        it is left out instead of failing on all GPUs
+        """
+        with self.files_lock:
+            self.truncated.add(os.path.abspath(path))
+
+    def start_process_queue(self):
+        self.process_table = ResultsStore()
+        self.dump_lock = Lock()
+        self.csv_writer = TableWriter(os.path.join(self.output_dir, 'process_table.csv'), csv_columns, csv_header)
+        self.star_writer = TableWriter(os.path.join(self.output_dir, 'micrographs_all_gctf.star'), star_columns, star_header, sep='\t')
+        self.histograms = [Histogram(os.path.join(self.output_dir, 'histogram_resolution.png'), 'Resolution', 'Resolution (\u212B)', 'green'),
+                           Histogram(os.path.join(self.output_dir, 'histogram_defocus.png'), 'Defocus', 'Defocus (\u03BCm)', 'blue')]
+        self.dump_scheduler = DumpScheduler(float(self.main_options.get('dump_min_interval', 2.0)),
+                                            float(self.main_options.get('dump_max_latency', 10.0)))
+        # micrographs wait in the first queue for motioncor. The queues between
+        # the stages are bounded, so motioncor can only run a few micrographs
+        # ahead of gctf and the post-processing
+        # All queues hand out the micrographs in the order of the queue policy
+        stage_queue_size = max(1, len(self.main_options['GPUs']) * self.get_slots('gctf_slots'))
+        policy = self.main_options.get('queue_policy', 'fifo')
+        self.queue = MicrographQueue(policy)
+        self.files = set() # every file is only queued once
+        self.truncated = set() # files that are smaller than their header declares
+        self.rejected = set() # files that do not fit to the gain reference or the first micrograph
+        self.files_lock = Lock()
+        self.gain_header = self.read_gain_header()
+        self.reference_header = None
+        self.gctf_queue = MicrographQueue(policy, maxsize=stage_queue_size)
+        self.gctf_retries = deque() # failed micrographs, which the gctf workers take first
+        self.postprocessing_queue = MicrographQueue(policy, maxsize=stage_queue_size)
+
+    def start_event_notifier(self):
+        """
+        Watch the input directory for new files that have the
+        specified file extension. The files that are already there
+        are queued as well, unless watch_backfill is off.
+        Network file systems are polled, unless the watcher option
+        selects a backend
+        """
+        self.watcher = create_watcher(self.main_options, self.input_dir, self.file_extension, self.new_file,
+                                      self.logger, exclude=[self.output_dir], truncated=self.truncated_file)
+        self.watcher.start(backfill=bool(self.main_options.get('watch_backfill', True)))
+
+    def pass_to_next_stage(self, queue, micrograph):
+        """
+        Put the micrograph in the queue of the next stage. The stage queues
+        are bounded, so this waits until there is space, unless we abort.
+        :return: True if the micrograph was passed on
+        """
+        while not self.stop_event.is_set():
+            try:
+                queue.put(micrograph, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get_slots(self, stage_slots=None):
+        """
+        Number of jobs that may run at the same time on one GPU. If a stage is
+        given, the number of jobs of this stage, which is at most the number
+        of GPU slots
+        :param stage_slots: 'motioncor_slots' or 'gctf_slots'
+        """
+        gpu_slots = max(1, int(self.main_options.get('gpu_slots', 2)))
+        if stage_slots is None:
+            return gpu_slots
+        return max(1, min(gpu_slots, int(self.main_options.get(stage_slots, 1))))
+
+    def motioncor_worker(self, gpu_id):
+        while (not self.stop_event.is_set()):
+            micrograph = self.queue.get()
+            if micrograph is None:
+                # in case we want to stop the worker if queue is empty,
+                # we just put None inside the Queue
+                break
+
+            # continue after the last stage that was completed before a restart
+            try:
+                stage = self.resume(micrograph)
+            except Exception as ex:
+                self.logger.error(str(ex))
+                continue
+            if stage == 'done':
+                continue
+            elif stage == 'gctf':
+                self.pass_to_next_stage(self.postprocessing_queue, micrograph)
+                continue
+            elif stage == 'motioncor':
+                self.pass_to_next_stage(self.gctf_queue, micrograph)
+                continue
+
+            # leave the micrograph to the other GPUs if this GPU is quarantined or it failed here before
+            if self.avoid_gpu(micrograph, gpu_id) or not self.gpu_health.acquire(gpu_id):
+                self.queue.put(micrograph)
+                self.stop_event.wait(1)
+                continue
+
+            self.logger.debug('Motioncor on GPU {} for micrograph {}'.format(gpu_id, micrograph.basename))
+            try:
+                with self.gpu_scheduler.slot(gpu_id, 'motioncor'):
+                    self.motioncor(micrograph, gpu_id)
+            except Exception as ex:
+                self.logger.error(str(ex))
+            # only aligned micrographs go on to gctf
+            if 'gctf_input' in micrograph.files:
+                self.gpu_health.success(gpu_id)
+                self.ledger.record(micrograph, 'motioncor')
+                self.pass_to_next_stage(self.gctf_queue, micrograph)
+            elif self.stop_event.is_set():
+                break # aborted, which is not a failure of the GPU
+            else:
+                # a micrograph that failed here before does not count against the GPU again
+                if gpu_id not in micrograph.failed_gpus:
+                    self.gpu_health.failure(gpu_id, 'motioncor')
+                else:
+                    self.gpu_health.release(gpu_id)
+                self.retry(micrograph, gpu_id, self.queue.put)
+
+        if self.stop_event.is_set():
+            self.logger.debug("Motioncor worker thread for GPU {} was shut down".format(str(gpu_id)))
+
+    def gctf_worker(self, gpu_id):
+        stop = False
+        while (not self.stop_event.is_set()) and not stop:
+            micrograph = self.next_gctf_micrograph()
+            if micrograph is None:
+                break
+            if self.avoid_gpu(micrograph, gpu_id) or not self.gpu_health.acquire(gpu_id):
+                self.gctf_retries.append(micrograph)
+                self.stop_event.wait(1)
+                continue
+
+            # collect more micrographs for a gctf batch until it is full or the waiting time is over
+            batch = [micrograph]
+            deadline = time.time() + self.gctf.batch_wait
+            while len(batch) < self.gctf.batch_size and not self.stop_event.is_set():
+                try:
+                    micrograph = self.next_gctf_micrograph(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                if micrograph is None:
+                    stop = True
+                    break
+                batch.append(micrograph)
+
+            self.logger.debug('Gctf on GPU {} for micrographs {}'.format(gpu_id, ', '.join(m.basename for m in batch)))
+            try:
+                with self.gpu_scheduler.slot(gpu_id, 'gctf', len(batch)):
+                    self.gctf.process_batch(batch, gpu_id)
+            except Exception as ex:
+                self.logger.error(str(ex))
+            # a single bad micrograph in the batch does not count against the GPU,
+            # neither do micrographs that failed on it before or an abort
+            if any('gctf_ctf_fit' in micrograph.files for micrograph in batch):
+                self.gpu_health.success(gpu_id)
+            elif not self.stop_event.is_set() and any(gpu_id not in micrograph.failed_gpus for micrograph in batch):
+                self.gpu_health.failure(gpu_id, 'gctf')
+            else:
+                self.gpu_health.release(gpu_id)
+            for micrograph in batch:
+                if 'gctf_ctf_fit' in micrograph.files:
+                    self.ledger.record(micrograph, 'gctf')
+                elif self.stop_event.is_set():
+                    continue
+                elif self.retry(micrograph, gpu_id, self.gctf_retries.append):
+                    continue
+                self.pass_to_next_stage(self.postprocessing_queue, micrograph)
+
+        if self.stop_event.is_set():
+            self.logger.debug("Gctf worker thread for GPU {} was shut down".format(str(gpu_id)))
+
+    def avoid_gpu(self, micrograph, gpu_id):
+        """
+        :return: True if the micrograph failed on this GPU before and another GPU can take it
+        """
+        return gpu_id in micrograph.failed_gpus and len(self.gpu_health.healthy(exclude=micrograph.failed_gpus)) > 0
+
+    def next_gctf_micrograph(self, timeout=None):
+        """
+        The micrographs that failed before come first. They are not put back in the
+        bounded gctf queue, because the gctf workers are its only consumers and would
+        wait for themselves
+        :param timeout: seconds to wait for a micrograph, None to wait until one arrives or we stop
+        :return: the next micrograph or None to stop
+        :raise Empty: if no micrograph arrived within the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.stop_event.is_set():
+                return None
+            try:
+                return self.gctf_retries.popleft()
+            except IndexError:
+                pass
+            wait = 1.0 if deadline is None else min(1.0, deadline - time.time())
+            if wait <= 0:
+                raise Empty
+            try:
+                return self.gctf_queue.get(timeout=wait)
+            except Empty:
+                continue
+
+    def retry(self, micrograph, gpu_id, requeue):
+        """
+        Put a micrograph that failed on a GPU back in the queue of the stage,
+        so that another GPU can process it
+        :param requeue: function that puts the micrograph back without blocking
+        :return: True if the micrograph is processed again
+        """
+        micrograph.attempts += 1
+        micrograph.failed_gpus.add(gpu_id)
+        max_attempts = int(self.main_options.get('max_attempts', 3))
+        if micrograph.attempts >= max_attempts or self.stop_event.is_set():
+            self.logger.error('Giving up on micrograph {} after {} failed attempts'.format(micrograph.basename, micrograph.attempts))
+            return False
+        self.logger.warning('Micrograph {} failed on GPU {}, putting it back in the queue (attempt {} of {})'.format(
+            micrograph.basename, gpu_id, micrograph.attempts + 1, max_attempts))
+        requeue(micrograph)
+        return True
+
+    def postprocessing_worker(self):
+        while (not self.stop_event.is_set()):
+            micrograph = self.postprocessing_queue.get()
+            if micrograph is None:
+                break
+            try:
+                micrograph.collect_pending()
+                self.process_table_update(micrograph)
+                self.gpu_scheduler.micrograph_done()
+                self.ledger.record(micrograph, 'done')
+                self.move_frames(micrograph)
+            except Exception as ex:
+                self.logger.error(str(ex))
+
+        if self.stop_event.is_set():
+            self.logger.debug("Post-processing worker thread was shut down")
+
+    def start_process_pool(self):
+        """
+        Start a pool of processes for the png files and log copies, so the GPU
+        workers can go on with the next micrograph. By default it uses the CPU
+        cores that are not busy with the GPU jobs
+        """
+        gpu_jobs = len(self.main_options['GPUs']) * self.get_slots()
+        cpu_workers = process_pool_size(self.main_options, gpu_jobs)
+        self.logger.debug('Starting process pool with {} workers'.format(cpu_workers))
+        self.executor = create_process_pool(cpu_workers)
+        self.motioncor.executor = self.executor
+        self.gctf.executor = self.executor
+
+    def start_archiver(self):
+        """
+        Start the threads that move the frames to $OUTPUT_DIR/frames
+        """
+        self.archiver = FrameArchiver.from_options(os.path.join(self.output_dir, 'frames'), self.logger, self.main_options)
+        self.archiver.start()
+
+    def move_frames(self, micrograph):
+        """
+        Move the micrograph after processing to $OUTPUT_DIR/frames in the background
+        """
+        self.archiver.move(micrograph.files['raw'])
+
+    def resume(self, micrograph):
+        """
+        Restore the results of a micrograph from the ledger
+        :return: the last completed stage of the micrograph or None
+        """
+        stage = self.ledger.restore(micrograph)
+        if stage is None:
+            return None
+        self.logger.info('Micrograph {} was already processed until stage {}'.format(micrograph.basename, stage))
+        if stage == 'done':
+            # the frames were not moved before the restart
+            self.move_frames(micrograph)
+            return stage
+        # the static files might not have been finished before the restart
+        self.motioncor.submit_static_files(micrograph)
+        if stage == 'gctf':
+            self.gctf.submit_static_files(micrograph)
+        return stage
+
+    def start_ledger(self):
+        """
+        Open the ledger in the output directory and rebuild the process table
+        from the micrographs that were completed before
+        """
+        self.ledger = Ledger(self.output_dir)
+        self.process_table.extend(self.ledger.load_records())
+        if len(self.process_table) > 0:
+            self.logger.info('Loaded {} processed micrographs from {}'.format(len(self.process_table), self.ledger.path))
+
+    def start_worker_threads(self):
+        """
+        Start motioncor and gctf threads for each GPU ID and one thread
+        for the post-processing. The stages are connected by queues, so
+        motioncor of the next micrograph runs while gctf processes the
+        previous one. The number of threads per GPU and stage are set by
+        motioncor_slots and gctf_slots, the number of jobs running at the
+        same time on a GPU is limited by gpu_slots
+        :return:
+        """
+        GPUs = self.main_options['GPUs']
+        self.gpu_scheduler = GpuScheduler(GPUs, self.get_slots())
+        self.gpu_health = GpuHealth.from_options(GPUs, self.logger, self.main_options)
+        self.motioncor_threads = [Thread(target=self.motioncor_worker, args=(i,)) for i in GPUs for _ in range(self.get_slots('motioncor_slots'))]
+        self.gctf_threads = [Thread(target=self.gctf_worker, args=(i,)) for i in GPUs for _ in range(self.get_slots('gctf_slots'))]
+        self.postprocessing_threads = [Thread(target=self.postprocessing_worker)]
+        for thread in self.motioncor_threads:
+            self.logger.debug('Starting motioncor thread for GPU with ID: {}'.format(thread._args[0]))
+        for thread in self.gctf_threads:
+            self.logger.debug('Starting gctf thread for GPU with ID: {}'.format(thread._args[0]))
+        for thread in self.motioncor_threads + self.gctf_threads + self.postprocessing_threads:
+            thread.daemon = True
+            thread.start()
+
+    def process_table_update(self, micrograph):
+        """
+        Add the micrograph data to the results
+        """
+        self.process_table.append(micrograph.to_record())
+        self.dump_scheduler.notify()
+
+    def process_table_dump(self):
+        """
+        Write the new results to the csv file and to the star
+        file to use as input for relion.
+        Copy a project.html file inside the output directory
+        """
+
+        project_html = os.path.join(self.output_dir, 'project.html')
+
+        if not os.path.isfile(project_html):
+            template = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates', 'project.html')
+            shutil.copyfile(template, project_html)
+
+        self.dump_lock.acquire()
+        # the workers keep adding results while we write the snapshot,
+        # each output is only written if it has new results
+        records = self.process_table.snapshot()
+        if records:
+            for histogram in self.histograms:
+                histogram.write(records)
+
+            self.logger.debug('Writing data to process table csv file and star file')
+            self.csv_writer.write(records)
+            self.star_writer.write(records)
+
+        self.dump_lock.release()
+
+    def start_writer_thread(self):
+        """
+        Write the results in the background, so neither the GUI nor the
+        workers wait for the files and the histograms
+        """
+        self.writer_thread = Thread(target=self.writer)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def writer(self):
+        while self.dump_scheduler.wait(self.stop_event):
+            try:
+                self.process_table_dump()
+            except Exception as ex:
+                self.logger.error('Could not write the results: {}'.format(str(ex)))
+        self.logger.debug('Writer thread was shut down')
+
+    def stop(self):
+        # set stop events
+        self.watcher.stop()
+        self.stop_event.set()
+
+        # clear all remaining items in the queues
+        stages = [(self.queue, self.motioncor_threads),
+                  (self.gctf_queue, self.gctf_threads),
+                  (self.postprocessing_queue, self.postprocessing_threads)]
+        for queue, threads in stages:
+            queue.queue.clear()
+        self.gctf_retries.clear()
+
+        # kill running processes
+        self.motioncor.abort()
+        self.gctf.abort()
+
+        # wait for all threads to finish before continuing
+        for queue, threads in stages:
+            for thread in threads:
+                try:
+                    queue.put_nowait(None)
+                except Full:
+                    pass # the thread is not waiting for new micrographs
+            for thread in threads:
+                thread.join()
+        self.executor.shutdown(wait=True)
+        # multi-GB copies would block the GUI, the frames that are not moved yet stay in the
+        # input directory and are moved after the next start, when they are resumed from the ledger
+        if self.archiver.pending():
+            self.logger.info('The frames of {} micrographs are moved after the next start'.format(self.archiver.pending()))
+        self.archiver.stop(wait=False)
+        self.ledger.close()
+        self.dump_scheduler.wake()
+        self.writer_thread.join()
+
+        # write data one last time
+        self.process_table_dump()
+        # report how well the GPUs were used with this number of slots
+        for line in self.gpu_scheduler.report() + self.gpu_health.report() + [self.archiver.report()]:
+            self.logger.info(line)
+        # and which timeouts were learned from the runtimes
+        for timeouts in (self.motioncor.timeouts, self.gctf.timeouts):
+            self.logger.info('Timeout of ' + timeouts.report())
+
+    def status(self):
+        gpus = self.gpu_health.status()
+        with self.files_lock:
+            truncated, rejected = len(self.truncated), len(self.rejected)
+        return 'Processing... ({}{}{}{})'.format(self.gpu_scheduler.throughput(), '; ' + gpus if gpus else '',
+                                                 '; {} truncated files'.format(truncated) if truncated else '',
+                                                 '; {} rejected files'.format(rejected) if rejected else '')
+
+class Gctf:
+    def __init__(self, logger, options, output_directory, executable):
+        self.logger = logger
+        self.options = options.copy()
+        self.executable = executable
+
+        # micrographs can be processed in batches with a single gctf process.
+        # A batch is started when it is full or the first micrograph waited for batch_wait seconds
+        self.batch_size = max(1, int(self.options.pop('batch_size', 1)))
+        self.batch_wait = float(self.options.pop('batch_wait', 0))
+
+        # create required folders
+        self.output_dir = output_directory
+        self.results_dir = os.path.join(self.output_dir, 'gctf')
+        if not os.path.isdir(self.results_dir):
+            os.makedirs(self.results_dir)
+        self.static_dir = os.path.join(self.output_dir, 'static', 'gctf') # directory to which png files will be saved to
+        if not os.path.isdir(self.static_dir):
+            os.makedirs(self.static_dir)
+        self.executor = None # process pool for the png files, if None they are created right away
+        self.timeouts = AdaptiveTimeout('gctf', self.options['timeout'])
+        self.processes = execution.ProcessRegistry()
+        self.fix_mrc_headers = False # the mrc files are not changed for the png files
+        self.thumbnail_sizes = [512] # sizes of the png files, the first one is the preview
+
+
+    def __call__(self, micrograph, gpu_id: int):
+        """
+        Process a single micrograph with gctf
+
+        :param micrograph: Micrograph object
+        :param gpu_id: gpu ID on which the processing will occur
+        :return:
+        """
+        self.process_batch([micrograph], gpu_id)
+
+    def link_input(self, micrograph):
+        """
+        Create a symbolic link to the input file inside the gctf directory.
+        A link of an earlier run, a retry or a resumed micrograph is reused
+        if it points to the input file and replaced otherwise
+        :return: path to the gctf input file
+        """
+        assert 'gctf_input' in micrograph.files, "No gctf input file found for micrograph {}".format(micrograph.basename)
+        # gctf_input = os.path.join(self.results_dir, os.path.basename(micrograph.files['gctf_input']))
+        gctf_input = os.path.join(self.results_dir, micrograph.basename + '.mrc')
+        source = micrograph.files['gctf_input']
+
+        if os.path.islink(gctf_input) and os.path.realpath(gctf_input) == os.path.realpath(source):
+            return gctf_input
+        if os.path.lexists(gctf_input):
+            # a stale link or the copy of an earlier run
+            os.remove(gctf_input)
+
+        self.logger.debug('Copying {file} to {dir}'.format(file=source, dir=self.results_dir))
+        try:
+            os.symlink(source, gctf_input)
+        except OSError:
+            shutil.copy(source, gctf_input)
+        return gctf_input
+
+    def process_batch(self, micrographs, gpu_id: int):
+        """
+        Gctf is called as: executable [options] [file(s)]
+        All micrographs are processed by one gctf process, which saves the
+        CUDA context setup for every micrograph after the first one.
+        The micrographs are processed inside the directory of the input file
+        Gctf can not be called on symbolic links
+
+        :param micrographs: list of Micrograph objects
+        :param gpu_id: gpu ID on which the processing will occur
+        :return:
+        """
+        gctf_inputs = [self.link_input(micrograph) for micrograph in micrographs]
+        if len(micrographs) == 1:
+            name = 'micrograph {}'.format(micrographs[0].basename)
+        else:
+            name = 'batch of {} micrographs ({} ... {})'.format(len(micrographs), micrographs[0].basename, micrographs[-1].basename)
+
+        # set up additional options
+        options = self.options.copy()
+        options['gid'] = gpu_id
+        ctfstar = os.path.join(self.results_dir, micrographs[0].basename + '.star')
+        options['ctfstar'] = ctfstar
+        options.pop('timeout')
+        size = sum(file_size(gctf_input) for gctf_input in gctf_inputs)
+        timeout = self.timeouts.timeout(size, len(micrographs))
+        trials = options.pop('trials')
+        cc_cutoff = options.pop('cc_cutoff')
+
+        # generate the command
+        cmd = [ self.executable ]
+        for k, v in options.items():
+            cmd.append('--' + k)
+            cmd.append(str(v))
+        cmd.extend(gctf_inputs)
+
+        # log the command executed
+        self.logger.info('>>> '+' '.join(map(str, cmd)))
+
+        # the stdout of a single micrograph is its log file, the stdout of a batch is split afterwards
+        if len(micrographs) == 1:
+            run_log = os.path.splitext(gctf_inputs[0])[0] + '_gctf.log'
+        else:
+            run_log = os.path.join(self.results_dir, micrographs[0].basename + '_batch_gctf.log')
+
+        # execute the command
+        for i in range(trials):
+            result = execution.run(cmd, run_log, timeout, GCTF_ERROR_MARKERS, self.processes)
+
+            if result.aborted:
+                self.logger.info('Gctf for {} was aborted'.format(name))
+                return  # no more trials
+
+            if result.timed_out:
+                self.timeouts.killed()
+                self.logger.warning('Timeout of {:.0f} s expired for gctf on {}. (trial {}, {})'.format(timeout,name,i+1,self.timeouts.report()))
+                continue #retry
+
+            if result.stderr or result.returncode != 0:
+                self.logger.warning('Gctf for {} did not finish successfully. (exit code {}, trial {})'.format(name,result.returncode,i+1))
+                continue    # retry
+
+            if result.errors:
+                self.logger.error('Gctf for {} did not finish successfully. ({}, trial {})'.format(name,result.errors[0],i+1))
+                continue    # retry
+
+            parse_start = time.perf_counter()
+            with open(run_log, 'r') as log:
+                outputs = parse_output(log, gctf_inputs)
+            parse_time = (time.perf_counter() - parse_start) / len(micrographs)
+            if outputs is None:
+                self.logger.error('Gctf for {} did not finish successfully. (No final values found, trial {})'.format(name,i+1))
+                continue    # retry
+
+            self.logger.debug('Gctf for {} was executed successfully. (trial {})'.format(name,i+1))
+
+            # Read contents of the gctf star file, one row for each micrograph
+            # FIXME: columns have the form '_rlnMicrographName #1', '_rlnCtfImage #2' .. KEEP IT!
+            self.logger.debug('Reading Gctf star file {}'.format(ctfstar))
+            star_columns, star_rows = read_star_file(ctfstar, gctf_inputs)
+            if len(star_rows) != len(micrographs):
+                self.logger.error('Gctf for {} did not finish successfully. (Missing rows in {}, trial {})'.format(name,ctfstar,i+1))
+                continue    # retry
+
+            for micrograph, gctf_input, (micrograph_log, final_values), star_row in zip(micrographs, gctf_inputs, outputs, star_rows):
+                self.read_results(micrograph, gctf_input, micrograph_log if len(micrographs) > 1 else None,
+                                  final_values, cc_cutoff, dict(zip(star_columns, star_row)), parse_time)
+
+            # Delete gctf star file and the log of the batch, we don't need them anymore
+            self.logger.debug('Removing Gctf star file {}'.format(ctfstar))
+            os.remove(ctfstar)
+            if len(micrographs) > 1:
+                os.remove(run_log)
+            self.timeouts.record(result.runtime, size)
+            return
+
+        if len(micrographs) > 1:
+            # do not lose the whole batch because of a single bad micrograph
+            self.logger.warning('Could not process gctf for {}. Processing the micrographs one by one'.format(name))
+            for micrograph in micrographs:
+                try:
+                    self.process_batch([micrograph], gpu_id)
+                except Exception as ex:
+                    # the other micrographs of the batch still get their chance
+                    self.logger.error('Gctf for micrograph {} failed: {}'.format(micrograph.basename, str(ex)))
+            return
+
+        self.logger.error('Could not process gctf for {}'.format(name))
+        return
+
+    def read_results(self, micrograph, gctf_input, log, final_values, cc_cutoff, star_results, parse_time=0.0):
+        """
+        Read the results of the CTF fit of one micrograph and add them to the micrograph data
+        :param log: gctf stdout belonging to this micrograph, None if it was written to the log file already
+        :param final_values: dictionary with the final values of the CTF fit from the log
+        :param star_results: dictionary with the star file columns and values of this micrograph
+        :param parse_time: time it took to parse the share of this micrograph of the stdout
+        """
+        micrograph.files['gctf_log'] = os.path.splitext(gctf_input)[0] + '_gctf.log'
+        if log is not None:
+            with open(micrograph.files['gctf_log'], "w") as gctf_log:
+                gctf_log.write(log)
+
+        micrograph.files['gctf_ctf_fit'] = re.sub(r'.mrc$', '.ctf', gctf_input)
+        micrograph.files['gctf_epa_log'] = re.sub(r'.mrc$', '_EPA.log', gctf_input)
+        # micrograph.files['gctf_ctf_fit'] = os.path.splitext(gctf_input)[0] + '.ctf'
+        # micrograph.files['gctf_epa_log'] = os.path.splitext(gctf_input)[0] + '_EPA.log'
+
+        # the results of the last iteration
+        results = dict(final_values)
+        results['Defocus'] = (results['Defocus_U'] + results['Defocus_V']) / 2 / 10000
+        results['delta_Defocus'] = (results['Defocus_U'] - results['Defocus_V']) / 10000
+
+        if 'Phase_shift' in results:
+            results['Phase_shift'] = results['Phase_shift'] / 180
+
+        # find out the resolution at which the cross correlation falls beneath the cc_cutoff
+        self.logger.debug('Reading the EPA log file')
+        parse_start = time.perf_counter()
+        results['Resolution'] = resolution_at_cutoff(read_epa_log(micrograph.files['gctf_epa_log']), cc_cutoff)
+        results.pop('CCC', None)  # we don't need this column anymore
+        results['gctf_parse_time'] = parse_time + time.perf_counter() - parse_start
+        self.logger.debug('Parsed the gctf output of micrograph {} in {:.1f} ms'.format(micrograph.basename, results['gctf_parse_time'] * 1000))
+
+        # log the results
+        self.logger.info('Results for micrograph {name}: '
+                         'Defocus: {defocus} \u03BCm, Resolution: {resolution} \u212B, Phase shift: {phase_shift} \u03c0'.format(name=micrograph.basename,
+                                                                                              defocus=results['Defocus'],
+                                                                                              resolution=results['Resolution'],
+                                                                                              phase_shift=0 if 'Phase_shift' not in results else results['Phase_shift']))
+
+        results.update(star_results)
+
+        # add results to the rest of the data
+        micrograph.add_data(results)
+
+        self.submit_static_files(micrograph)
+
+    def submit_static_files(self, micrograph):
+        """
+        Convert mrc to png and copy the log file to the static dir in the process pool.
+        The ctf image will have the same name as the micrograph, but it is inside static/gctf, so we know what it is
+        """
+        micrograph.add_data_when_done(self.executor, create_static_files,
+                                      micrograph.files['gctf_ctf_fit'], micrograph.files['gctf_log'], self.static_dir, False, 'gctf_ctf_fit',
+                                      {
+                                          'gctf_ctf_fit': 'static/gctf/{}.png'.format(micrograph.basename),
+                                          'gctf_log': 'static/gctf/{}'.format(os.path.basename(micrograph.files['gctf_log']))
+                                      }, self.fix_mrc_headers, self.thumbnail_sizes)
+
+    def abort(self):
+        # only kill the processes we started
+        self.processes.kill_all()
+
+class Motioncor:
+    def __init__(self, logger, options, output_directory, executable):
+        self.logger = logger
+        self.options = options
+        self.output_dir = output_directory
+        self.results_dir = os.path.join(self.output_dir, 'motioncor')
+        if not os.path.isdir(self.results_dir):
+            os.makedirs(self.results_dir)
+        self.static_dir = os.path.join(self.output_dir, 'static', 'motioncor') # directory to which png files will be saved to
+        if not os.path.isdir(self.static_dir):
+            os.makedirs(self.static_dir)
+        self.executable = executable
+        self.executor = None # process pool for the png files, if None they are created right away
+        self.timeouts = AdaptiveTimeout('motioncor', self.options['timeout'])
+        self.processes = execution.ProcessRegistry()
+        self.fix_mrc_headers = False # the mrc files are not changed for the png files
+        self.thumbnail_sizes = [512] # sizes of the png files, the first one is the preview
+        self.power_spectrum_tile = 512 # tile size of the power spectrum, 0 for no power spectrum
+
+    def __call__(self, micrograph, gpu_id):
+        """
+        output DW and nonDW file is inside the results directory
+        :param micrograph:
+        :param gpu_id:
+        :return:
+        """
+        assert 'motioncor_input' in micrograph.files, "No motioncor input file found for micrograph {}".format(micrograph.basename)
+
+        basename = os.path.basename(micrograph.abspath)
+
+        # set options
+        options = self.options.copy() # create a copy of the dict, or other threads might override values
+        options['Gpu'] = gpu_id
+        # options['OutMrc'] = os.path.splitext(micrograph.abspath)[0] + '.mrc' #FIXME what is the output name in case of mrc input?
+        output_mrc = os.path.join(self.results_dir, os.path.splitext(basename)[0] + '.mrc')
+        options['OutMrc'] = output_mrc
+        options.pop('timeout')
+        size = file_size(micrograph.files['motioncor_input'])
+        timeout = self.timeouts.timeout(size)
+        trials = options.pop('trials')
+
+        cmd = [self.executable]
+
+        # convert options to a list of strings and append it to the command list
+        for key, val in options.items():
+            if key == 'InTiff' or key == 'InMrc':
+                val = micrograph.files['motioncor_input']
+            cmd.append('-' + key)
+            if type(val) == list:
+                val = ' '.join(map(str, val))
+                cmd.append(val)
+            else:
+                cmd.append(str(val))
+
+        self.logger.info('>>> ' + ' '.join(map(str, cmd)))
+        log_file = re.sub(r'.mrc$', '_DriftCorr.log', output_mrc)
+        for i in range(trials):
+            # the stdout goes right to the log file
+            result = execution.run(cmd, log_file, timeout, MOTIONCOR_ERROR_MARKERS, self.processes)
+
+            if result.aborted:
+                self.logger.info('Motioncor for micrograph {} was aborted'.format(micrograph.basename))
+                return  # no more trials
+
+            if result.timed_out:
+                self.timeouts.killed()
+                self.logger.warning('Timeout of {:.0f} s expired for motioncor on micrograph {}. (trial {}, {})'.format(timeout,micrograph.basename,i+1,self.timeouts.report()))
+                continue
+
+            if result.stderr or result.errors or result.returncode != 0:
+                self.logger.warning('Motioncor for micrograph {name} did not finish successfully. (trial {i})\n'
+                                    '{err}'.format(name = micrograph.basename,i=i+1,
+                                                   err=result.stderr or '\n'.join(result.errors) or 'exit code {}'.format(result.returncode)))
+                continue
+
+            else:
+                self.logger.debug('Motioncor for micrograph {} was executed successfully. (trial {})'.format(micrograph.basename,i+1))
+
+                micrograph.files['motioncor_aligned_no_DW'] = output_mrc
+                micrograph.files['motioncor_aligned_DW'] = re.sub(r'.mrc$', '_DW.mrc', output_mrc)
+                micrograph.files['motioncor_log'] = log_file
+
+                self.submit_static_files(micrograph)
+
+                micrograph.files['gctf_input'] = micrograph.files['motioncor_aligned_no_DW']
+                self.timeouts.record(result.runtime, size)
+                return
+
+        self.logger.error("No motioncor results could be generated for micrograph {}".format(micrograph.basename))
+
+    def submit_static_files(self, micrograph):
+        """
+        Crop the image and copy the log file to the static directory in the process pool.
+        The micrograph results are updated with the new file paths, when this is done
+        """
+        self.logger.debug('Creating png file from {}'.format(micrograph.files['motioncor_aligned_DW']))
+        micrograph.add_data_when_done(self.executor, create_static_files,
+                                      micrograph.files['motioncor_aligned_DW'], micrograph.files['motioncor_log'], self.static_dir, True, 'motioncor_aligned_DW',
+                                      {
+                                          'motioncor_aligned_DW': 'static/motioncor/{}_DW.png'.format(micrograph.basename),
+                                          'motioncor_log': 'static/motioncor/{}'.format(os.path.basename(micrograph.files['motioncor_log']))
+                                      }, self.fix_mrc_headers, self.thumbnail_sizes)
+        if self.power_spectrum_tile > 0:
+            # the power spectrum of the sum without dose weighting, which keeps the high resolution Thon rings
+            self.logger.debug('Creating power spectrum of {}'.format(micrograph.files['motioncor_aligned_no_DW']))
+            micrograph.add_data_when_done(self.executor, create_power_spectrum,
+                                          micrograph.files['motioncor_aligned_no_DW'],
+                                          os.path.join(self.static_dir, micrograph.basename + '_ps.png'), self.power_spectrum_tile,
+                                          {'motioncor_power_spectrum': 'static/motioncor/{}_ps.png'.format(micrograph.basename)})
+
+    def abort(self):
+        # only kill the processes we started
+        self.processes.kill_all()
+
+class AdaptiveTimeout:
+    """
+    Learns the timeout of a stage from the runtimes of the successful runs.
+    The runtimes are normalized by the size of the input files, the timeout is a
+    high percentile of them times a margin. The configured timeout is the upper
+    limit and is used until enough runs were recorded
+    """
+    def __init__(self, name, cap, enabled=True, percentile=95.0, margin=2.0, minimum=30.0, min_samples=10, window=200):
+        self.name = name
+        self.cap = float(cap)
+        self.enabled = enabled
+        self.percentile = percentile
+        self.margin = margin
+        self.minimum = minimum
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=window) # seconds per byte of the latest runs
+        self.kills = 0
+        self.lock = Lock()
+
+    @classmethod
+    def from_options(cls, name, cap, main_options):
+        """
+        Creates the timeout with the settings of the Main options
+        """
+        return cls(name, cap,
+                   enabled=bool(main_options.get('adaptive_timeout', True)),
+                   percentile=float(main_options.get('timeout_percentile', 95.0)),
+                   margin=float(main_options.get('timeout_margin', 2.0)),
+                   minimum=float(main_options.get('timeout_minimum', 30.0)),
+                   min_samples=int(main_options.get('timeout_min_samples', 10)))
+
+    def record(self, runtime, size):
+        if size > 0:
+            with self.lock:
+                self.samples.append(runtime / size)
+
+    def killed(self):
+        with self.lock:
+            self.kills += 1
+
+    def timeout(self, size, count=1):
+        """
+        :param size: size of the input files in bytes
+        :param count: number of micrographs processed at once, the cap is multiplied by it
+        :return: timeout in seconds
+        """
+        cap = self.cap * count
+        with self.lock:
+            if not self.enabled or size <= 0 or len(self.samples) < self.min_samples:
+                return cap
+            seconds_per_byte = np.percentile(self.samples, self.percentile)
+        return min(cap, max(self.minimum, seconds_per_byte * size * self.margin))
+
+    def report(self):
+        with self.lock:
+            if not self.enabled or len(self.samples) < self.min_samples:
+                learned = 'fixed timeout of {:.0f} s'.format(self.cap)
+            else:
+                learned = 'learned timeout of {:.1f} s per GB'.format(
+                    min(self.cap, np.percentile(self.samples, self.percentile) * 1e9 * self.margin))
+            return '{}: {} from {} runs, {} killed'.format(self.name, learned, len(self.samples), self.kills)
+
+class GpuHealth:
+    """
+    Circuit breaker for the GPUs. A GPU is quarantined after max_failures
+    consecutive failed jobs and gets no more micrographs. After the cooldown
+    one probe job is allowed on it: if it succeeds the GPU is healthy again,
+    otherwise it stays quarantined for another cooldown. A probe that tells
+    nothing about the GPU has to be released, so that there is another one
+    """
+    HEALTHY = 'healthy'
+    QUARANTINED = 'quarantined'
+    PROBING = 'probing'
+
+    def __init__(self, gpu_ids, logger, max_failures=3, cooldown=300.0):
+        self.logger = logger
+        self.max_failures = max(1, max_failures)
+        self.cooldown = cooldown
+        self.lock = Lock()
+        self.state = {gpu_id: self.HEALTHY for gpu_id in gpu_ids}
+        self.consecutive_failures = {gpu_id: 0 for gpu_id in gpu_ids}
+        self.failures = {gpu_id: 0 for gpu_id in gpu_ids}
+        self.quarantined_until = {gpu_id: 0.0 for gpu_id in gpu_ids}
+
+    @classmethod
+    def from_options(cls, gpu_ids, logger, main_options):
+        return cls(gpu_ids, logger,
+                   max_failures=int(main_options.get('gpu_max_failures', 3)),
+                   cooldown=float(main_options.get('gpu_quarantine', 300.0)))
+
+    def add(self, gpu_id):
+        with self.lock:
+            if gpu_id not in self.state:
+                self.state[gpu_id] = self.HEALTHY
+                self.consecutive_failures[gpu_id] = 0
+                self.failures[gpu_id] = 0
+                self.quarantined_until[gpu_id] = 0.0
+
+    def acquire(self, gpu_id):
+        """
+        :return: True if a worker of the GPU may take the next micrograph
+        """
+        with self.lock:
+            state = self.state[gpu_id]
+            if state == self.HEALTHY:
+                return True
+            if state == self.QUARANTINED and time.time() >= self.quarantined_until[gpu_id]:
+                # only a single worker probes the GPU
+                self.state[gpu_id] = self.PROBING
+                self.logger.info('Probing GPU {} after {:.0f} s in quarantine'.format(gpu_id, self.cooldown))
+                return True
+            return False
+
+    def success(self, gpu_id):
+        with self.lock:
+            if self.state[gpu_id] == self.QUARANTINED:
+                return # the job was started before the quarantine, only a probe lifts it
+            if self.state[gpu_id] == self.PROBING:
+                self.logger.info('GPU {} is healthy again'.format(gpu_id))
+            self.state[gpu_id] = self.HEALTHY
+            self.consecutive_failures[gpu_id] = 0
+
+    def failure(self, gpu_id, reason=''):
+        with self.lock:
+            self.failures[gpu_id] += 1
+            self.consecutive_failures[gpu_id] += 1
+            if self.state[gpu_id] == self.PROBING or self.consecutive_failures[gpu_id] >= self.max_failures:
+                self.state[gpu_id] = self.QUARANTINED
+                self.quarantined_until[gpu_id] = time.time() + self.cooldown
+                self.logger.error('GPU {} failed {} times in a row{}, taking it out of rotation for {:.0f} s'.format(
+                    gpu_id, self.consecutive_failures[gpu_id], ' ({})'.format(reason) if reason else '', self.cooldown))
+
+    def release(self, gpu_id):
+        """
+        The job neither succeeded nor counts as a failure of the GPU, e.g. a micrograph that failed
+        on it before. A probe is repeated after another cooldown, otherwise nothing changes
+        """
+        with self.lock:
+            if self.state[gpu_id] == self.PROBING:
+                self.state[gpu_id] = self.QUARANTINED
+                self.quarantined_until[gpu_id] = time.time() + self.cooldown
+                self.logger.info('The probe of GPU {} was inconclusive, probing again in {:.0f} s'.format(gpu_id, self.cooldown))
+
+    def healthy(self, exclude=()):
+        """
+        :return: the GPUs that are not quarantined, except the excluded ones
+        """
+        with self.lock:
+            return [gpu_id for gpu_id, state in self.state.items() if state != self.QUARANTINED and gpu_id not in exclude]
+
+    def status(self):
+        """
+        :return: short description of the GPUs that are not healthy, or an empty string
+        """
+        with self.lock:
+            sick = ['GPU {} {}'.format(gpu_id, state) for gpu_id, state in sorted(self.state.items(), key=lambda item: str(item[0]))
+                    if state != self.HEALTHY]
+        return ', '.join(sick)
+
+    def report(self):
+        with self.lock:
+            return ['GPU {}: {}, {} failed jobs'.format(gpu_id, self.state[gpu_id], self.failures[gpu_id])
+                    for gpu_id in sorted(self.state, key=str)]
+
+class GpuScheduler:
+    """
+    Limits the number of jobs that run at the same time on each GPU and
+    measures how well the GPUs are used, so that different slot counts
+    can be compared
+    """
+    def __init__(self, gpu_ids, slots):
+        self.slots = slots
+        self.semaphores = {gpu_id: BoundedSemaphore(slots) for gpu_id in gpu_ids}
+        self.lock = Lock()
+        self.start_time = time.time()
+        self.finished = 0
+        self.running = {gpu_id: 0 for gpu_id in gpu_ids}
+        self.busy_since = {gpu_id: 0.0 for gpu_id in gpu_ids}
+        self.busy_time = {gpu_id: 0.0 for gpu_id in gpu_ids}    # time with at least one job running
+        self.job_time = {gpu_id: 0.0 for gpu_id in gpu_ids}     # sum of the time of all jobs
+        self.jobs = {gpu_id: {} for gpu_id in gpu_ids}          # number of micrographs per stage
+
+    @contextmanager
+    def slot(self, gpu_id, stage, micrographs=1):
+        """
+        Wait for a free slot on the GPU and hold it while the job runs
+        :param stage: name of the stage, used for the report
+        :param micrographs: number of micrographs processed by the job
+        """
+        with self.semaphores[gpu_id]:
+            start = time.time()
+            with self.lock:
+                if self.running[gpu_id] == 0:
+                    self.busy_since[gpu_id] = start
+                self.running[gpu_id] += 1
+            try:
+                yield
+            finally:
+                end = time.time()
+                with self.lock:
+                    self.running[gpu_id] -= 1
+                    if self.running[gpu_id] == 0:
+                        self.busy_time[gpu_id] += end - self.busy_since[gpu_id]
+                    self.job_time[gpu_id] += end - start
+                    self.jobs[gpu_id][stage] = self.jobs[gpu_id].get(stage, 0) + micrographs
+
+    def micrograph_done(self):
+        with self.lock:
+            self.finished += 1
+
+    def throughput(self):
+        elapsed = time.time() - self.start_time
+        return '{} micrographs, {:.1f} per hour'.format(self.finished, self.finished / elapsed * 3600)
+
+    def report(self):
+        """
+        :return: list of lines with the throughput and the use of each GPU
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        lines = ['{} slots per GPU: {} in {:.0f} s'.format(self.slots, self.throughput(), elapsed)]
+        with self.lock:
+            for gpu_id in sorted(self.semaphores):
+                busy = self.busy_time[gpu_id]
+                if self.running[gpu_id] > 0:
+                    busy += time.time() - self.busy_since[gpu_id]
+                jobs = ', '.join('{} {}'.format(n, stage) for stage, n in sorted(self.jobs[gpu_id].items()))
+                lines.append('GPU {id}: busy {busy:.0%} of the time, {concurrent:.2f} jobs on average ({jobs})'.format(
+                    id=gpu_id, busy=busy / elapsed, concurrent=self.job_time[gpu_id] / elapsed, jobs=jobs or 'no jobs'))
+        return lines
+
+class Ledger:
+    """
+    Records the last completed stage, the files and the results of each micrograph
+    in a SQLite database inside the output directory. After a restart, the
+    micrographs continue after their last completed stage.
+    The stages are 'motioncor', 'gctf' and 'done'
+    """
+    def __init__(self, output_directory):
+        self.path = os.path.join(output_directory, 'ledger.sqlite')
+        self.lock = Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS micrographs ('
+                                    'micrograph TEXT PRIMARY KEY, stage TEXT, files TEXT, data TEXT, updated REAL)')
+
+    def record(self, micrograph, stage):
+        """
+        Save the state of the micrograph after completing the stage
+        """
+        files = json.dumps(micrograph.files)
+        data = json.dumps(micrograph.to_record(), default=to_json_type)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO micrographs VALUES (?, ?, ?, ?, ?)',
+                                    (micrograph.basename, stage, files, data, time.time()))
+
+    def restore(self, micrograph):
+        """
+        Restore the files and the results of the micrograph, if the output
+        files of the last completed stage still exist. Micrographs that are
+        done are never processed again
+        :return: last completed stage or None
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT stage, files, data FROM micrographs WHERE micrograph = ?',
+                                          (micrograph.basename,)).fetchone()
+        if row is None:
+            return None
+        stage, files, data = row[0], json.loads(row[1]), json.loads(row[2])
+        # a micrograph that is done has its row in the tables, whatever the outcome of gctf
+        required = {'motioncor': 'gctf_input', 'gctf': 'gctf_ctf_fit'}.get(stage)
+        if required is not None and not os.path.isfile(files.get(required, '')):
+            return None
+        files['raw'] = micrograph.files['raw']
+        micrograph.files.update(files)
+        micrograph.clear_data()
+        micrograph.add_data(data)
+        return stage
+
+    def load_records(self):
+        """
+        :return: list with the results of all completed micrographs
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT data FROM micrographs WHERE stage = 'done' ORDER BY updated").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class ResultsStore:
+    """
+    Append-only store of the results of the micrographs. Adding a result is
+    O(1), the writer works on a snapshot of the results
+    """
+    def __init__(self):
+        self.records = []
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def extend(self, records):
+        with self.lock:
+            self.records.extend(records)
+
+    def snapshot(self):
+        """
+        :return: list of the results added so far. The records are never changed,
+        so the list can be read while new results are added
+        """
+        with self.lock:
+            return self.records[:]
+
+class DumpScheduler:
+    """
+    Decides when the results are written. New results are collected until no
+    result arrived for min_interval seconds, but a result waits at most
+    max_latency seconds. Without new results nothing is written
+    """
+    def __init__(self, min_interval=2.0, max_latency=10.0):
+        self.min_interval = min_interval
+        self.max_latency = max(min_interval, max_latency)
+        self.condition = Condition()
+        self.first_change = None # time of the first result that was not written yet
+        self.last_change = None
+        self.last_dump = 0.0
+
+    def notify(self):
+        with self.condition:
+            self.last_change = time.time()
+            if self.first_change is None:
+                self.first_change = self.last_change
+                self.condition.notify_all()
+
+    def wake(self):
+        """
+        Wake up the waiting writer, e.g. after the stop event was set
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait(self, stop_event):
+        """
+        Wait until the results should be written. The results that arrive
+        from then on are written by the next dump
+        :return: False if we stop
+        """
+        with self.condition:
+            while not stop_event.is_set():
+                if self.first_change is None:
+                    self.condition.wait()
+                    continue
+                now = time.time()
+                due = max(self.last_dump + self.min_interval,
+                          min(self.last_change + self.min_interval, self.first_change + self.max_latency))
+                if now < due:
+                    self.condition.wait(due - now)
+                    continue
+                self.first_change = None
+                self.last_dump = now
+                return True
+        return False
+
+class Histogram:
+    """
+    Histogram of a column of the results, only drawn again when the column has new values
+    """
+    def __init__(self, path, column, xlabel, color):
+        self.path = path
+        self.column = column
+        self.xlabel = xlabel
+        self.color = color
+        self.seen = 0 # number of records that were checked for new values
+
+    def write(self, records):
+        """
+        :param records: all results so far
+        """
+        new_values = any(self.column in record for record in records[self.seen:])
+        self.seen = len(records)
+        if not new_values:
+            return
+
+        # matplotlib is only needed here, do not load it with the pipeline.
+        # pyplot is not thread-safe, the figure is drawn without it
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        values = pd.to_numeric(pd.Series([record.get(self.column) for record in records]), errors='coerce').dropna()
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        axes.hist(values, edgecolor='black', color=self.color)
+        axes.set_title(self.column)
+        axes.grid(True)
+        axes.set_xlabel(self.xlabel)
+        figure.savefig(self.path)
+
+class TableWriter:
+    """
+    Writes the results to a csv or star file. The header is written once and
+    only the rows that were added since the last write are appended. The whole
+    file is only written again, to a temporary file that replaces it, when
+    the columns change
+    """
+    def __init__(self, path, select_columns, header, sep=','):
+        """
+        :param select_columns: function that returns the columns of the file from all the columns of the results
+        :param header: function that returns the header of the file for these columns
+        """
+        self.path = path
+        self.select_columns = select_columns
+        self.header = header
+        self.sep = sep
+        self.all_columns = {} # all columns of the results in the order of appearance
+        self.columns = None
+        self.written = 0
+
+    def write(self, records):
+        """
+        :param records: all results so far, the records that were written before must not change
+        """
+        new_records = records[self.written:]
+        if not new_records:
+            return
+        for record in new_records:
+            for column in record:
+                self.all_columns.setdefault(column)
+        columns = self.select_columns(list(self.all_columns))
+        if not columns:
+            return
+
+        if columns != self.columns or not os.path.isfile(self.path):
+            self.columns = columns
+            content = self.header(columns) + self.format(records)
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w') as f:
+                f.write(content)
+            os.replace(temp_file, self.path)
+        else:
+            # a single write, readers see the complete rows
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, self.format(new_records).encode('utf-8'))
+            finally:
+                os.close(fd)
+        self.written = len(records)
+
+    def format(self, records):
+        # skip the micrographs without values in this file, like the failed ones in the star file
+        records = [record for record in records if any(column in record for column in self.columns)]
+        if not records:
+            return ''
+        return pd.DataFrame(records, columns=self.columns).to_csv(index=False, header=False, sep=self.sep)
+
+def csv_columns(columns):
+    # the micrograph name is the first column, like the index of the table
+    return ['micrograph'] + [column for column in columns if column != 'micrograph']
+
+def csv_header(columns):
+    return ','.join(columns) + '\n'
+
+def star_columns(columns):
+    """
+    :return: the relion columns, like '_rlnDefocusU #3', sorted by their number
+    """
+    rln = [column for column in columns if column.startswith('_rln')]
+    return sorted(rln, key=lambda column: int(column.split()[1][1:]))
+
+def star_header(columns):
+    return 'data_\nloop_\n' + '\n'.join(columns) + '\n'
+
+class MicrographQueue(Queue):
+    """
+    Queue that hands out the micrographs in the order of a policy:
+    newest: the most recently recorded micrograph first
+    fifo: in the order they were put in the queue
+    smallest: shortest job first, the fewest pixels of all frames first, or the smallest file
+              if the header does not tell the dimensions
+    manual_last: files from the file list after the files from the input directory
+    """
+    policies = ('newest', 'fifo', 'smallest', 'manual_last')
+
+    def __init__(self, policy='fifo', maxsize=0):
+        assert policy in self.policies, 'Unknown queue policy {}'.format(policy)
+        self.policy = policy
+        self.counter = itertools.count() # keeps the order of micrographs with the same priority
+        super().__init__(maxsize)
+
+    def priority(self, micrograph):
+        if micrograph is None:
+            return float('-inf') # None stops the workers, so it comes first
+        if self.policy == 'newest':
+            return -micrograph.mtime
+        if self.policy == 'smallest':
+            pixels = micrograph.pixels()
+            return micrograph.size if pixels is None else pixels
+        if self.policy == 'manual_last':
+            return 1 if micrograph.source == 'manual' else 0
+        return 0
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (self.priority(item), next(self.counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+class Micrograph:
+    """
+    A recorded micrograph on its way through the pipeline. The CTF values are
+    plain attributes and the other results, like the paths of the png files,
+    are kept in a dict. The micrograph becomes a row of the results in to_record
+    """
+    # the CTF values in the order of the columns of the results
+    CTF_FIELDS = ('Defocus_U', 'Defocus_V', 'Angle', 'Phase_shift', 'Defocus', 'delta_Defocus', 'Resolution')
+    __slots__ = ('id', 'basename', 'abspath', 'source', 'mtime', 'size', 'frames', 'width', 'height',
+                 'files', 'extra', 'logger', 'pending', 'attempts', 'failed_gpus') + CTF_FIELDS
+    counter = 0
+
+    def __init__(self, path, logger, source='watch'):
+        self.id = Micrograph.counter
+        Micrograph.counter += 1
+        self.basename = os.path.splitext(os.path.basename(path))[0]
+        self.abspath = os.path.abspath(path)
+        self.source = source # 'watch' for files from the input directory, 'manual' for files from the file list
+        try:
+            stat = os.stat(self.abspath)
+            self.mtime = stat.st_mtime
+            self.size = stat.st_size
+        except OSError:
+            self.mtime = 0.0
+            self.size = 0
+        # from the header of the frames, None if not known
+        self.frames = None
+        self.width = None
+        self.height = None
+        self.files = {
+            'raw': self.abspath,
+            'motioncor_input': self.abspath,
+        }
+        self.clear_data()
+        self.logger = logger
+        self.pending = [] # futures of jobs in the process pool
+        self.attempts = 0 # failed attempts on a GPU
+        self.failed_gpus = set()
+
+    def pixels(self):
+        """
+        :return: number of pixels of all frames from the header, None if it is not known
+        """
+        if None in (self.frames, self.width, self.height):
+            return None
+        return self.frames * self.width * self.height
+
+    def clear_data(self):
+        for field in self.CTF_FIELDS:
+            setattr(self, field, None) # None if not known
+        self.extra = {} # the other results
+
+    def add_data(self, dictionary):
+        """
+        Add results, the CTF values go to their attributes and the rest to the extra results
+        """
+        for key, value in dictionary.items():
+            if key in self.CTF_FIELDS:
+                setattr(self, key, None if value is None else float(value))
+            elif key != 'micrograph':
+                self.extra[key] = value
+
+    @property
+    def data(self):
+        return self.to_record()
+
+    def to_record(self):
+        """
+        :return: dict with the results, the row of the micrograph in the results
+        """
+        record = {'micrograph': self.basename}
+        for field in self.CTF_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                record[field] = value
+        record.update(self.extra)
+        return record
+
+    def add_data_when_done(self, executor, function, *args):
+        """
+        Run the function in the executor. The dictionary it returns is added
+        to the data in collect_pending. Without an executor the function
+        runs right away
+        """
+        if executor is None:
+            self.add_data(function(*args))
+        else:
+            self.pending.append(executor.submit(function, *args))
+
+    def collect_pending(self):
+        """
+        Wait for the jobs in the process pool and add their results to the data
+        """
+        for future in self.pending:
+            try:
+                self.add_data(future.result())
+            except Exception as ex:
+                self.logger.warning('Could not create static files for micrograph {}: {}'.format(self.basename, str(ex)))
+        self.pending = []
+
+    def to_dict(self):
+        """
+        The state of the micrograph that is sent between the coordinator and the worker agents
+        """
+        return {
+            'abspath': self.abspath,
+            'source': self.source,
+            'frames': self.frames,
+            'width': self.width,
+            'height': self.height,
+            'files': self.files,
+            'data': json.loads(json.dumps(self.to_record(), default=to_json_type)),
+        }
+
+    def update_from_dict(self, dictionary, output_dir):
+        """
+        Take over the files and the results of a micrograph that was processed somewhere else.
+        The input files stay as they are and only files inside the output directory are taken over,
+        because the raw file is moved later
+        :return: keys of the files outside of the output directory, which were ignored
+        """
+        ignored = []
+        output_dir = os.path.realpath(output_dir)
+        for key, path in dictionary['files'].items():
+            if key in ('raw', 'motioncor_input'):
+                continue
+            if not isinstance(path, str) or \
+                    os.path.commonpath([output_dir, os.path.realpath(os.path.join(output_dir, path))]) != output_dir:
+                ignored.append(key)
+            else:
+                self.files[key] = path
+        for key in ('frames', 'width', 'height'):
+            if dictionary.get(key) is not None:
+                setattr(self, key, dictionary[key])
+        self.clear_data()
+        self.add_data(dictionary['data'])
+        return ignored
+
+def configure_stages(main_options, motioncor, gctf):
+    """
+    Set up the motioncor and gctf stages with the Main options
+    """
+    for stage in (motioncor, gctf):
+        stage.timeouts = AdaptiveTimeout.from_options(stage.timeouts.name, stage.options['timeout'], main_options)
+        stage.fix_mrc_headers = bool(main_options.get('fix_mrc_headers', False))
+        stage.thumbnail_sizes = [int(size) for size in main_options.get('thumbnail_sizes', [512, 2048])]
+    if main_options.get('power_spectrum', True):
+        motioncor.power_spectrum_tile = int(main_options.get('power_spectrum_tile', 512))
+    else:
+        motioncor.power_spectrum_tile = 0
+
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def process_pool_size(main_options, gpu_jobs):
+    """
+    :param gpu_jobs: number of GPU jobs that can run at the same time on this computer
+    :return: the number of workers in the process pool, cpu_workers or the spare CPU cores
+    """
+    cpu_workers = int(main_options.get('cpu_workers', 0))
+    if cpu_workers <= 0:
+        cpu_workers = max(1, (os.cpu_count() or 1) - gpu_jobs - 1)
+    return cpu_workers
+
+def create_process_pool(workers):
+    """
+    The workers are started by a fork server. Forking this process while its threads
+    hold locks, like the one of the logging module, could deadlock the workers.
+    The workers ignore Ctrl+C, they are shut down with the pipeline
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                               initializer=ignore_interrupt)
+
+def ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def crop_image(input_mrc, output_dir, equalize_hist=False, sizes=(512,)):
+    """
+    Converts mrc to png and saves the image inside the output directory
+    basename.ext will be saved as basename.png, binned to the first size.
+    Larger sizes are saved as basename_size.png, if the image is larger than them.
+    The mrc file is memory-mapped read-only, the header is not changed on disk.
+    Header problems, like the missing map ID in the motioncor output, are tolerated
+    :param input_mrc:
+    :param output_dir:
+    :param equalize_hist: equalize the histogram of the binned images
+    :param sizes: maximum width and height of the png files in pixels
+    :return: list with the sizes and the png files that were written
+    """
+    # matplotlib is only needed here, do not load it with the pipeline
+    from matplotlib.image import imsave
+
+    logging.captureWarnings(True)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # the header is not valid
+        with mrcfile.mmap(input_mrc, mode='r', permissive=True) as mrc:
+            if mrc.data is None:
+                raise ValueError('Could not read the data of {}'.format(input_mrc))
+            image_ary = mrc.data
+            # only the first section of a stack is read from the file
+            while image_ary.ndim > 2:
+                image_ary = image_ary[0]
+
+            base = os.path.splitext(os.path.basename(input_mrc))[0]
+            written = []
+            previous_factor = None
+            for i, size in enumerate(sizes):
+                factor = max(1, int(np.ceil(max(image_ary.shape) / size)))
+                if factor == previous_factor:
+                    continue # the same image as for the smaller size
+                previous_factor = factor
+                binned = bin_image(image_ary, factor)
+                if equalize_hist == True:
+                    binned = equalize_histogram(binned)
+                output_image = os.path.join(output_dir, base + ('.png' if i == 0 else '_{}.png'.format(size)))
+                imsave(output_image, binned, cmap='gray')
+                written.append((size, output_image))
+    return written
+
+def bin_image(image, factor):
+    """
+    Block binning, the mean of each factor x factor block. The pixels that
+    do not fill a block at the edges are dropped
+    """
+    if factor <= 1:
+        return np.asarray(image, dtype=np.float32)
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = np.asarray(image[:height * factor, :width * factor], dtype=np.float32)
+    return blocks.reshape(height, factor, width, factor).mean(axis=(1, 3))
+
+def equalize_histogram(image, bins=256):
+    """
+    Histogram equalization like skimage.exposure.equalize_hist
+    :return: image with values between 0 and 1
+    """
+    hist, edges = np.histogram(image, bins=bins)
+    cdf = hist.cumsum()
+    cdf = cdf / float(cdf[-1])
+    centers = (edges[:-1] + edges[1:]) / 2
+    return np.interp(image, centers, cdf).astype(np.float32)
+
+def fix_mrc_header(input_mrc):
+    """
+    Write a valid header to the mrc file, output .mrc files from motioncor need this correction
+    """
+    logging.captureWarnings(True)
+    with mrcfile.open(input_mrc, mode='r+', permissive=True) as mrc:
+        mrc.header.map = mrcfile.constants.MAP_ID
+        mrc.update_header_from_data()
+
+def create_static_files(input_mrc, log_file, static_dir, equalize_hist, image_key, data, fix_header=False, thumbnail_sizes=(512,)):
+    """
+    Converts the mrc file to png and copies the log file to the static directory.
+    This is run in the process pool, so the GPU workers do not wait for it
+    :param image_key: key of the png file of the mrc file in data, like 'gctf_ctf_fit'
+    :param data: dictionary that is returned, when the files were created
+    :param fix_header: write a valid header to the mrc file, otherwise it is not changed
+    :param thumbnail_sizes: sizes of the png files, the first one is the preview
+    :return: data with the larger png files and the time and bytes it took to create them
+    """
+    if fix_header:
+        fix_mrc_header(input_mrc)
+    start = time.perf_counter()
+    thumbnails = crop_image(input_mrc, static_dir, equalize_hist=equalize_hist, sizes=thumbnail_sizes)
+    shutil.copy(log_file, static_dir)
+
+    data = dict(data)
+    stage = image_key.split('_')[0]
+    for size, thumbnail in thumbnails[1:]:
+        data['{}_{}'.format(image_key, size)] = '{}_{}.png'.format(os.path.splitext(data[image_key])[0], size)
+    data[stage + '_thumbnail_time'] = time.perf_counter() - start
+    data[stage + '_thumbnail_bytes'] = sum(os.path.getsize(thumbnail) for _, thumbnail in thumbnails)
+    return data
+
+def to_json_type(value):
+    """
+    Convert numpy values for json.dumps
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
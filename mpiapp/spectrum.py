@@ -0,0 +1,90 @@
+"""
+Power spectrum of the aligned micrographs, computed on the CPU right after motioncor.
+It shows the Thon rings even if gctf fails or is slow.
+"""
+import logging
+import warnings
+
+import numpy as np
+import mrcfile
+
+
+def power_spectrum(image, tile=512):
+    """
+    Periodogram average of the power spectra of non-overlapping tiles of the image
+    :param image: 2D array
+    :param tile: size of the tiles in pixels, the image must be at least this large
+    :return: centered power spectrum of size tile x tile
+    """
+    tile = min(tile, *image.shape)
+    rows, columns = image.shape[0] // tile, image.shape[1] // tile
+    tiles = np.asarray(image[:rows * tile, :columns * tile], dtype=np.float32)
+    tiles = tiles.reshape(rows, tile, columns, tile).swapaxes(1, 2).reshape(-1, tile, tile)
+    tiles = tiles - tiles.mean(axis=(1, 2), keepdims=True)
+    # a window against the edges of the tiles, which show up as a cross in the spectrum
+    window = np.hanning(tile).astype(np.float32)
+    tiles *= np.outer(window, window)
+
+    spectrum = np.zeros((tile, tile), dtype=np.float64)
+    for start in range(0, len(tiles), 16): # a few tiles at once keep the memory low
+        spectrum += (np.abs(np.fft.fft2(tiles[start:start + 16])) ** 2).sum(axis=0)
+    return np.fft.fftshift(spectrum / len(tiles))
+
+
+def thon_score(spectrum, low=0.04, high=0.45, smooth=9):
+    """
+    How well the Thon rings are visible: the oscillation of the rotational average of
+    the log power spectrum around its smooth background, relative to the standard error
+    of the rotational average. Without rings the score is below about 2
+    :param spectrum: centered power spectrum of power_spectrum
+    :param low: lowest frequency of the rings as fraction of the spectrum size
+    :param high: highest frequency of the rings as fraction of the spectrum size
+    :param smooth: number of radii of the moving average that is the background
+    """
+    log_spectrum = np.log(spectrum + 1e-12)
+    size = spectrum.shape[0]
+    y, x = np.indices(spectrum.shape)
+    radius = np.hypot(y - size // 2, x - size // 2).astype(int).ravel()
+    counts = np.bincount(radius)
+    mean = np.bincount(radius, log_spectrum.ravel()) / np.maximum(counts, 1)
+    square = np.bincount(radius, log_spectrum.ravel() ** 2) / np.maximum(counts, 1)
+    error = np.sqrt(np.maximum(square - mean ** 2, 0) / np.maximum(counts, 1))
+
+    band = slice(int(low * size), int(high * size))
+    padded = np.pad(mean, smooth // 2, mode='edge')
+    background = np.convolve(padded, np.ones(smooth) / smooth, mode='valid')
+    residual = (mean - background)[band]
+    return float(np.sqrt(np.mean(residual ** 2)) / max(np.mean(error[band]), 1e-12))
+
+
+def create_power_spectrum(input_mrc, output_png, tile, data):
+    """
+    Write the power spectrum of the mrc file to a png file and compute the Thon ring score.
+    This is run in the process pool, so the GPU workers do not wait for it
+    :param data: dictionary that is returned with the score, when the png file was written
+    :return: data
+    """
+    # matplotlib is only needed here, do not load it with the pipeline
+    from matplotlib.image import imsave
+
+    logging.captureWarnings(True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # the header of the motioncor output is not valid
+        with mrcfile.mmap(input_mrc, mode='r', permissive=True) as mrc:
+            if mrc.data is None:
+                raise ValueError('Could not read the data of {}'.format(input_mrc))
+            image = mrc.data
+            while image.ndim > 2:
+                image = image[0]
+            spectrum = power_spectrum(image, tile)
+
+    # contrast of the log spectrum without the center
+    log_spectrum = np.log(spectrum + 1e-12)
+    center = spectrum.shape[0] // 2
+    log_spectrum[center - 2:center + 3, center - 2:center + 3] = np.median(log_spectrum)
+    low, high = np.percentile(log_spectrum, [1, 99.5])
+    imsave(output_png, np.clip(log_spectrum, low, high), cmap='gray')
+
+    data = dict(data)
+    data['Thon_score'] = thon_score(spectrum)
+    return data
@@ -0,0 +1,438 @@
+"""
+Watches the input directory for new micrographs. There are two backends:
+inotify only gets the events of finished files, so the writes to the multi-GB
+frame files do not wake up python. Network filesystems like NFS or CIFS do not
+send inotify events for files written by other computers, so their directories
+are polled instead. Files that are already in the directory when the watch
+starts are found with a scan of the directory.
+Every file that was found has to pass the ReadinessGate, so a file is only
+processed when it is complete.
+"""
+import os
+import time
+from threading import Thread, Event, Lock
+
+from headers import check_file, COMPLETE, INCOMPLETE, UNKNOWN, MISSING
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None # only the polling watcher is available
+
+WATCHERS = ('auto', 'inotify', 'polling')
+# file systems that do not send inotify events for writes of other computers
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', 'glusterfs', 'lustre',
+                       'gpfs', 'beegfs', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.ceph', '9p', 'afs')
+
+
+def has_extension(path, file_extension):
+    return os.path.splitext(path)[1] == file_extension
+
+
+def is_excluded(path, exclude):
+    """
+    :param exclude: absolute paths of directories, like the output directory
+    :return: True if the path is one of the directories or inside of them
+    """
+    path = os.path.abspath(path)
+    return any(path == directory or path.startswith(directory + os.sep) for directory in exclude)
+
+
+def scan_directory(directory, file_extension, recursive=False, exclude=()):
+    """
+    Find the files with the extension with os.scandir, which does not need a stat call for each file
+    :return: generator of the paths in the order of the directory entries
+    """
+    directories = [directory]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError:
+            continue # removed while we scan
+        for entry in entries:
+            try:
+                if entry.is_file() and has_extension(entry.name, file_extension):
+                    yield entry.path
+                elif recursive and entry.is_dir(follow_symlinks=False) and not is_excluded(entry.path, exclude):
+                    directories.append(entry.path)
+            except OSError:
+                continue
+
+
+def filesystem_type(path, mounts='/proc/mounts'):
+    """
+    :return: type of the file system the path is on, like 'ext4' or 'nfs4', None if it is not known
+    """
+    path = os.path.realpath(path)
+    mount_point, fstype = '', None
+    try:
+        with open(mounts, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces in the mount point are escaped
+                point = fields[1].replace('\\040', ' ')
+                if (path == point or path.startswith(point.rstrip('/') + '/')) and len(point) >= len(mount_point):
+                    mount_point, fstype = point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def select_watcher(watcher, input_dir):
+    """
+    :param watcher: one of WATCHERS, 'auto' polls network file systems and uses inotify otherwise
+    :return: 'inotify' or 'polling'
+    """
+    if watcher not in WATCHERS:
+        raise ValueError('Unknown watcher {}, use one of: {}'.format(watcher, ', '.join(WATCHERS)))
+    if watcher == 'inotify' and pyinotify is None:
+        raise ValueError('The inotify watcher needs pyinotify, install it or use the polling watcher')
+    if watcher == 'auto':
+        if pyinotify is None or filesystem_type(input_dir) in NETWORK_FILESYSTEMS:
+            return 'polling'
+        return 'inotify'
+    return watcher
+
+
+def create_watcher(main_options, input_dir, file_extension, callback, logger, exclude=(), truncated=None):
+    """
+    Create the watcher that is selected by the 'watcher' option
+    :param callback: called with the path of every complete file
+    :param truncated: called with the path and the Readiness of every truncated file
+    """
+    gate = ReadinessGate(callback, logger, truncated,
+                         stable_time=float(main_options.get('ready_stable_time', 5.0)),
+                         truncated_time=float(main_options.get('truncated_time', 60.0)))
+    recursive = bool(main_options.get('watch_recursive', False))
+    watcher = select_watcher(main_options.get('watcher', 'auto'), input_dir)
+    logger.info('Using the {} watcher for {}'.format(watcher, input_dir))
+    if watcher == 'polling':
+        return PollingWatcher(input_dir, file_extension, gate, logger, recursive, exclude,
+                              min_interval=float(main_options.get('poll_interval_min', 1.0)),
+                              max_interval=float(main_options.get('poll_interval_max', 10.0)),
+                              budget=float(main_options.get('poll_budget', 0.05)))
+    return InotifyWatcher(input_dir, file_extension, gate, logger, recursive, exclude)
+
+
+class ReadinessGate:
+    """
+    Passes the files on as soon as they are complete. MRC and TIFF files are complete
+    when they are as large as their headers declare. The other files and TIFF files
+    without the number of pages are complete when their writer closed them or when
+    their size did not change for stable_time seconds.
+    Files that stay smaller than their header declares for truncated_time seconds are
+    reported as truncated, so they do not use up the GPU retries. Their sizes are checked
+    again every stable_time seconds and they are waited for again if they grow, because the
+    watchers offer each file only once.
+    """
+    def __init__(self, callback, logger, truncated=None, stable_time=5.0, truncated_time=60.0, interval=0.5):
+        self.callback = callback
+        self.logger = logger
+        self.truncated = truncated
+        self.stable_time = stable_time
+        self.truncated_time = truncated_time
+        self.interval = interval
+        self.pending = {} # files that are not complete yet: (size, time of the last change of the size)
+        self.truncated_files = {} # files that were reported as truncated: (size, time of the last check)
+        self.lock = Lock()
+
+    def start(self):
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as ex:
+                self.logger.error('Could not check the pending files: {}'.format(str(ex)))
+
+    def add(self, path, closed=False):
+        """
+        :param closed: the writer closed the file or moved it in, so it is complete unless its header tells otherwise
+        """
+        readiness = check_file(path)
+        if readiness.state == COMPLETE or (closed and readiness.state == UNKNOWN):
+            self.remove(path)
+            self.callback(path)
+        elif readiness.state != MISSING:
+            with self.lock:
+                self.truncated_files.pop(path, None)
+                if path not in self.pending:
+                    self.logger.debug('Waiting for {} to be complete ({})'.format(path, readiness))
+                    self.pending[path] = (readiness.size, time.time())
+
+    def remove(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+            self.truncated_files.pop(path, None)
+
+    def check(self):
+        """
+        Check the pending files again
+        :return: number of files that were passed on
+        """
+        now = time.time()
+        with self.lock:
+            pending = list(self.pending.items())
+        passed = 0
+        for path, (size, changed) in pending:
+            readiness = check_file(path)
+            if readiness.size != size:
+                size, changed = readiness.size, now
+            if readiness.state == MISSING:
+                self.remove(path) # moved away
+            elif readiness.state == COMPLETE or (readiness.state == UNKNOWN and now - changed >= self.stable_time):
+                self.remove(path)
+                self.callback(path)
+                passed += 1
+            elif readiness.state == INCOMPLETE and now - changed >= self.truncated_time:
+                self.remove(path)
+                with self.lock:
+                    self.truncated_files[path] = (readiness.size, now)
+                self.logger.error('{} is truncated ({}), it is not processed'.format(path, readiness))
+                if self.truncated is not None:
+                    self.truncated(path, readiness)
+            else:
+                with self.lock:
+                    if path in self.pending:
+                        self.pending[path] = (size, changed)
+        self.check_truncated(now)
+        return passed
+
+    def check_truncated(self, now):
+        """
+        Wait again for the truncated files that grew, e.g. because the copy was resumed
+        """
+        with self.lock:
+            truncated = [(path, size) for path, (size, checked) in self.truncated_files.items()
+                         if now - checked >= self.stable_time]
+        for path, size in truncated:
+            try:
+                current = os.stat(path).st_size
+            except OSError:
+                current = None
+            with self.lock:
+                if path not in self.truncated_files:
+                    continue
+                if current is None:
+                    del self.truncated_files[path] # moved away
+                elif current != size:
+                    del self.truncated_files[path]
+                    self.pending[path] = (current, now)
+                    self.logger.info('{} grew after it was reported as truncated, waiting for it to be complete'.format(path))
+                else:
+                    self.truncated_files[path] = (size, now)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+
+class Watcher:
+    """
+    Passes the path of each file with the file extension in the input directory to the ReadinessGate
+    """
+    def __init__(self, input_dir, file_extension, gate, logger, recursive=False, exclude=()):
+        self.input_dir = os.path.abspath(input_dir)
+        self.file_extension = file_extension
+        self.gate = gate
+        self.logger = logger
+        self.recursive = recursive
+        self.exclude = [os.path.abspath(directory) for directory in exclude]
+
+    def start(self, backfill=True):
+        """
+        Start watching. With backfill, the files that are already there are passed on as well
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def backfill(self, directory):
+        files = 0
+        for path in scan_directory(directory, self.file_extension, self.recursive, self.exclude):
+            # the files might still be written
+            self.gate.add(path)
+            files += 1
+        if files:
+            self.logger.info('Found {} files in {}'.format(files, directory))
+
+    def log_start(self):
+        self.logger.debug('Watching {} for files with the extension {}{}'.format(
+            self.input_dir, self.file_extension, ' and its subdirectories' if self.recursive else ''))
+
+
+class InotifyWatcher(Watcher):
+    """
+    A file is finished when its writer closes it or it is moved in, e.g. by rsync or mv
+    """
+    def __init__(self, input_dir, file_extension, gate, logger, recursive=False, exclude=()):
+        super().__init__(input_dir, file_extension, gate, logger, recursive, exclude)
+        self.mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        if recursive:
+            # new subdirectories get a watch of their own
+            self.mask |= pyinotify.IN_CREATE
+
+    def start(self, backfill=True):
+        self.gate.start()
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.wm, self.process_event)
+        self.notifier.daemon = True
+        self.notifier.start()
+        self.watch(self.input_dir)
+        self.log_start()
+        # the watch exists before the scan, so no file is missed in between
+        if backfill:
+            self.backfill(self.input_dir)
+
+    def stop(self):
+        self.notifier.stop()
+        self.gate.stop()
+
+    def watch(self, directory):
+        self.wm.add_watch(directory, self.mask, rec=self.recursive, auto_add=self.recursive,
+                          exclude_filter=lambda path: is_excluded(path, self.exclude))
+
+    def process_event(self, event):
+        """
+        called by the notifier thread for every event of the mask
+        """
+        if not event.dir:
+            if event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO) and \
+                    has_extension(event.pathname, self.file_extension) and not is_excluded(event.pathname, self.exclude):
+                self.gate.add(event.pathname, closed=True)
+        elif self.recursive and event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO) and \
+                not is_excluded(event.pathname, self.exclude):
+            if event.mask & pyinotify.IN_MOVED_TO:
+                # pyinotify only adds created directories by itself
+                self.watch(event.pathname)
+            # files that were written before the watch of the new directory was added
+            self.backfill(event.pathname)
+
+
+class PollingWatcher(Watcher):
+    """
+    Finds new files with os.scandir. Only the directories that changed since the last pass
+    are read again, so a pass over a directory with a lot of processed files costs little.
+    The new files are passed to the ReadinessGate, which waits until they are complete.
+    The passes run every min_interval seconds while files arrive and slow down to
+    max_interval when nothing happens. All directories are read again from time to time,
+    because the modification times of directories can be cached by network file systems.
+    The passes use at most the budget fraction of the time.
+    """
+    # directories that changed less than this many seconds before they were read, are read again
+    SETTLE = 2.0
+
+    def __init__(self, input_dir, file_extension, gate, logger, recursive=False, exclude=(),
+                 min_interval=1.0, max_interval=10.0, budget=0.05):
+        super().__init__(input_dir, file_extension, gate, logger, recursive, exclude)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.budget = budget
+        self.interval = min_interval
+        self.directories = {} # directory: (modification time, time it was read)
+        self.known = set()    # files that were found before
+
+    def start(self, backfill=True):
+        self.stop_event = Event()
+        self.gate.start()
+        start = time.time()
+        files = self.scan(self.input_dir)
+        if backfill:
+            for path in sorted(files):
+                self.gate.add(path)
+            if files:
+                self.logger.info('Found {} files in {}'.format(len(files), self.input_dir))
+        self.full_scan_cost = time.time() - start
+        self.last_full_scan = time.time()
+        self.log_start()
+
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.gate.stop()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as ex:
+                self.logger.error('Could not poll {}: {}'.format(self.input_dir, str(ex)))
+
+    def poll(self):
+        """
+        One pass over the directories
+        :return: number of new files
+        """
+        start = time.time()
+        full = start - self.last_full_scan >= max(self.max_interval, self.full_scan_cost / self.budget)
+        files = []
+        for directory, (mtime, scanned) in list(self.directories.items()):
+            try:
+                current = os.stat(directory).st_mtime
+            except OSError:
+                del self.directories[directory] # removed
+                continue
+            if full or current != mtime or abs(scanned - current) < self.SETTLE:
+                files.extend(self.scan(directory))
+        for path in files:
+            self.gate.add(path)
+
+        cost = time.time() - start
+        if full:
+            self.full_scan_cost = cost
+            self.last_full_scan = start
+        self.adapt_interval(len(files), cost)
+        return len(files)
+
+    def adapt_interval(self, files, cost):
+        """
+        Poll fast while files arrive, slower if nothing happens,
+        but never spend more than the budget on polling
+        """
+        if files:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 1.5, self.max_interval)
+        self.interval = max(self.interval, cost / self.budget)
+
+    def scan(self, directory):
+        """
+        Read the directory and its new subdirectories
+        :return: the files that were not found before
+        """
+        scanned = time.time()
+        try:
+            mtime = os.stat(directory).st_mtime
+            entries = list(os.scandir(directory))
+        except OSError:
+            self.directories.pop(directory, None)
+            return []
+        self.directories[directory] = (mtime, scanned)
+        files = []
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    if has_extension(entry.name, self.file_extension) and entry.path not in self.known:
+                        self.known.add(entry.path)
+                        files.append(entry.path)
+                elif self.recursive and entry.is_dir(follow_symlinks=False) and \
+                        entry.path not in self.directories and not is_excluded(entry.path, self.exclude):
+                    files.extend(self.scan(entry.path))
+            except OSError:
+                continue
+        return files
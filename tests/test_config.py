@@ -0,0 +1,43 @@
+"""
+Tests of the options that follow from the Main options of a configuration file
+"""
+import os
+import json
+
+import pytest
+
+from pipeline import load_config, derive_stage_options
+
+MY_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'my_config.json')
+
+
+def test_my_config():
+    main_options, motioncor_options, gctf_options = load_config(MY_CONFIG)
+    assert motioncor_options['PixSize'] == 0.53
+    assert motioncor_options['kV'] == 300.0
+    # the motioncor section wins over the dose of the Main options
+    assert motioncor_options['FmDose'] == 1.6
+    # gctf gets the pixel size of the micrographs binned by FtBin 2
+    assert gctf_options['apix'] == pytest.approx(1.06)
+    assert (gctf_options['kV'], gctf_options['cs'], gctf_options['ac']) == (300.0, 2.62, 0.1)
+    assert motioncor_options['Gain'] == main_options['Gain']
+
+
+def test_stage_sections_win(tmp_path):
+    config = {'Main': {'apix': 0.8, 'kV': 200.0, 'dose_per_frame': 1.2, 'cs': 2.7},
+              'Motioncor': {'PixSize': 0.81},
+              'Gctf': {'apix': 0.9}}
+    filename = str(tmp_path / 'config.json')
+    with open(filename, 'w') as f:
+        json.dump(config, f)
+    main_options, motioncor_options, gctf_options = load_config(filename)
+    assert (motioncor_options['PixSize'], motioncor_options['kV'], motioncor_options['FmDose']) == (0.81, 200.0, 1.2)
+    assert (gctf_options['apix'], gctf_options['kV'], gctf_options['cs']) == (0.9, 200.0, 2.7)
+
+
+def test_derive_stage_options():
+    motioncor_options, gctf_options = derive_stage_options({'apix': '0.53'}, '2')
+    assert motioncor_options == {'PixSize': '0.53'}
+    assert gctf_options == {'apix': pytest.approx(1.06)}
+    # a line of the GUI that is being edited is taken as it is
+    assert derive_stage_options({'apix': '0.'}, '')[1] == {'apix': '0.'}
@@ -0,0 +1,120 @@
+"""
+Tests of the coordinator and the worker agents over a loopback connection,
+with fake motioncor and gctf executables
+"""
+import os
+import sys
+import time
+import socket
+import logging
+from threading import Thread
+
+import numpy as np
+import mrcfile
+
+from pipeline import load_config, Micrograph
+from distributed import Coordinator, Agent
+
+FAKE_MOTIONCOR = '''
+import sys
+import numpy as np
+import mrcfile
+options = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+output = options['-OutMrc']
+for path in (output, output[:-4] + '_DW.mrc'):
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(np.random.rand(64, 64).astype(np.float32))
+print('Aligned', options.get('-InMrc'))
+'''
+
+FAKE_GCTF = '''
+import os
+import sys
+import numpy as np
+import mrcfile
+arguments = sys.argv[1:]
+options = dict(zip(arguments[0::2], arguments[1::2]))
+inputs = [argument for argument in arguments if argument.endswith('.mrc')]
+rows = []
+for path in inputs:
+    base = path[:-4]
+    print('Processing ' + os.path.basename(path))
+    print('   Defocus_U   Defocus_V       Angle         CCC')
+    print('    21000.00    20000.00       10.00    0.100000  Final Values')
+    with mrcfile.new(base + '.ctf', overwrite=True) as mrc:
+        mrc.set_data(np.random.rand(64, 64).astype(np.float32))
+    with open(base + '_EPA.log', 'w') as epa:
+        epa.write('Resolution |CTFsim| EPA(Ln|F|) EPA(Ln|F|-Bg) CCC\\n')
+        for resolution, cc in ((10.0, 0.99), (6.0, 0.8), (4.0, 0.5)):
+            epa.write('%f 1 1 1 %f\\n' % (resolution, cc))
+    rows.append('%s %s.ctf:mrc 21000.00 20000.00 10.00' % (path, base))
+with open(options['--ctfstar'], 'w') as star:
+    star.write('data_\\nloop_\\n_rlnMicrographName #1\\n_rlnCtfImage #2\\n_rlnDefocusU #3\\n_rlnDefocusV #4\\n_rlnDefocusAngle #5\\n')
+    star.write('\\n'.join(rows) + '\\n')
+'''
+
+
+def executable(path, code):
+    with open(path, 'w') as f:
+        f.write('#!{}\n{}'.format(sys.executable, code))
+    os.chmod(path, 0o755)
+    return path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def test_coordinator_with_agents(tmp_path):
+    input_dir = tmp_path / 'frames'
+    input_dir.mkdir()
+    names = ['mic{:02d}'.format(n) for n in range(4)]
+    for name in names:
+        with mrcfile.new(str(input_dir / (name + '.mrc'))) as mrc:
+            mrc.set_data(np.zeros((3, 64, 64), np.float32))
+    motioncor = executable(str(tmp_path / 'motioncor'), FAKE_MOTIONCOR)
+    gctf = executable(str(tmp_path / 'gctf'), FAKE_GCTF)
+
+    main_options, motioncor_options, gctf_options = load_config()
+    main_options.update({'file_extension': 'mrc', 'watcher': 'polling', 'ready_stable_time': 0.5,
+                         'thumbnail_sizes': [32], 'cpu_workers': 1})
+    motioncor_options.pop('InTiff', None)
+    motioncor_options['InMrc'] = '{motioncor_input}'
+    logger = logging.getLogger('test_distributed')
+    port = free_port()
+    coordinator = Coordinator(main_options, motioncor_options, gctf_options, str(input_dir), str(tmp_path / 'output'),
+                              port=port, logger=logger)
+    coordinator.start()
+    try:
+        for gpus in ([0], [1]):
+            agent = Agent('localhost', port, gpus, motioncor, gctf, logger=logger)
+            Thread(target=agent.run, daemon=True).start()
+        deadline = time.time() + 60
+        while len(coordinator.process_table) < len(names) and time.time() < deadline:
+            time.sleep(0.2)
+    finally:
+        coordinator.stop()
+
+    assert len(coordinator.process_table) == len(names)
+    with open(str(tmp_path / 'output' / 'process_table.csv')) as f:
+        rows = f.read().splitlines()[1:]
+    assert sorted(row.split(',')[0] for row in rows) == names
+    # the coordinator moved the frames after the agents processed them
+    assert sorted(os.listdir(str(tmp_path / 'output' / 'frames'))) == [name + '.mrc' for name in names]
+
+
+def test_files_of_agents_outside_of_the_output(tmp_path):
+    micrograph = Micrograph(str(tmp_path / 'frames' / 'mic00.mrc'), logging.getLogger('test_distributed'))
+    output_dir = str(tmp_path / 'output')
+    ignored = micrograph.update_from_dict({
+        'files': {'raw': '/etc/passwd', 'motioncor_input': '/etc/passwd',
+                  'gctf_log': os.path.join(output_dir, 'gctf', 'mic00_gctf.log'),
+                  'gctf_ctf_fit': os.path.join(output_dir, '..', 'elsewhere.ctf'),
+                  'motioncor_log': '/etc/shadow'},
+        'data': {}}, output_dir)
+    assert sorted(ignored) == ['gctf_ctf_fit', 'motioncor_log']
+    assert micrograph.files == {'raw': str(tmp_path / 'frames' / 'mic00.mrc'),
+                                'motioncor_input': str(tmp_path / 'frames' / 'mic00.mrc'),
+                                'gctf_log': os.path.join(output_dir, 'gctf', 'mic00_gctf.log')}
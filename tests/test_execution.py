@@ -0,0 +1,104 @@
+"""
+Tests of running the GPU programs, with the Python interpreter as the program
+"""
+import os
+import sys
+import time
+from threading import Timer
+
+from execution import run, ProcessRegistry, STDERR_LIMIT
+
+MB = 1024 * 1024
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_stdout_in_log_file(tmp_path):
+    log_file = str(tmp_path / 'program.log')
+    result = run(python('print("first line"); print("second line")'), log_file, timeout=30)
+    assert result.ok and result.returncode == 0 and not result.timed_out
+    with open(log_file) as f:
+        assert f.read() == 'first line\nsecond line\n'
+
+
+def test_large_output_does_not_block(tmp_path):
+    # more than the pipe buffers take, on stdout and stderr at the same time
+    code = ('import sys\n'
+            'line = "x" * 1023 + "\\n"\n'
+            'for _ in range(8 * 1024):\n'
+            '    sys.stdout.write(line)\n'
+            '    sys.stderr.write(line)\n')
+    log_file = str(tmp_path / 'program.log')
+    result = run(python(code), log_file, timeout=30)
+    assert not result.timed_out
+    assert result.returncode == 0
+    assert os.path.getsize(log_file) == 8 * MB
+
+
+def test_stderr_is_truncated(tmp_path):
+    result = run(python('import sys; sys.stderr.write("e" * {})'.format(2 * STDERR_LIMIT)), str(tmp_path / 'program.log'), timeout=30)
+    assert len(result.stderr) == STDERR_LIMIT
+    assert not result.ok
+
+
+def test_error_markers(tmp_path):
+    code = ('import sys\n'
+            'print("Reading the frames")\n'
+            'print("Error: GPU out of memory")\n'
+            'sys.stderr.write("Segmentation fault\\n")\n')
+    result = run(python(code), str(tmp_path / 'program.log'), timeout=30, error_markers=('Error:', 'Segmentation fault'))
+    assert sorted(result.errors) == ['Error: GPU out of memory', 'Segmentation fault']
+    assert not result.ok
+
+
+def test_no_error_markers(tmp_path):
+    result = run(python('print("All done")'), str(tmp_path / 'program.log'), timeout=30, error_markers=('Error:',))
+    assert result.errors == []
+    assert result.ok
+
+
+def test_hanging_program_is_killed(tmp_path):
+    registry = ProcessRegistry()
+    start = time.time()
+    result = run(python('import time; print("started", flush=True); time.sleep(60)'), str(tmp_path / 'program.log'),
+                 timeout=1, registry=registry)
+    assert time.time() - start < 10
+    assert result.timed_out
+    assert result.returncode != 0
+    assert not result.ok
+    # the process is not registered anymore, so an abort does not kill it again
+    assert not registry.processes
+    with open(str(tmp_path / 'program.log')) as f:
+        assert f.read() == 'started\n'
+
+
+def test_exit_code(tmp_path):
+    result = run(python('import sys; sys.exit(3)'), str(tmp_path / 'program.log'), timeout=30)
+    assert result.returncode == 3
+    assert not result.ok
+
+
+def test_abort_kills_children(tmp_path):
+    # like a shell script around the program, the child keeps the pipes open
+    code = ('import subprocess, sys, time\n'
+            'subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])\n'
+            'time.sleep(60)\n')
+    registry = ProcessRegistry()
+    Timer(1, registry.kill_all).start()
+    start = time.time()
+    result = run(python(code), str(tmp_path / 'program.log'), timeout=None, registry=registry)
+    assert time.time() - start < 10
+    assert result.aborted
+    assert result.returncode < 0
+    assert not result.ok
+
+
+def test_no_runs_after_abort(tmp_path):
+    registry = ProcessRegistry()
+    registry.kill_all()
+    log_file = str(tmp_path / 'program.log')
+    result = run(python('print("started")'), log_file, timeout=30, registry=registry)
+    assert result.aborted and result.returncode is None
+    assert not os.path.exists(log_file)
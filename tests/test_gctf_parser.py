@@ -0,0 +1,98 @@
+"""
+Tests of the gctf parsers with recorded output of gctf
+"""
+import os
+
+import pytest
+
+from gctf_parser import parse_output, read_epa_log, resolution_at_cutoff, read_star_file, EPA_COLUMNS
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def data_file(name):
+    return os.path.join(DATA, name)
+
+
+def read(name):
+    with open(data_file(name)) as f:
+        return f.read()
+
+
+def test_single_output():
+    parts = parse_output(read('gctf_single.log'), ['/data/output/gctf/mic00.mrc'])
+    assert len(parts) == 1
+    log, values = parts[0]
+    assert log.rstrip('\n') == read('gctf_single.log').rstrip('\n')
+    # only the values of the 'Final Values' line count, not those of the refinement before
+    assert values == {'Defocus_U': 21402.19, 'Defocus_V': 20822.48, 'Angle': 38.13, 'CCC': 0.087552}
+
+
+def test_batch_output_split_by_name():
+    inputs = ['/data/output/gctf/mic00.mrc', '/data/output/gctf/mic01.mrc', '/data/output/gctf/mic02.mrc']
+    parts = parse_output(read('gctf_batch.log'), inputs)
+    assert [values['Defocus_U'] for _, values in parts] == [21402.19, 18204.55, 25010.83]
+    # the header belongs to the first file and each part starts with the line mentioning its file
+    assert parts[0][0].startswith('****')
+    assert parts[1][0].startswith('Processing mic01.mrc')
+    assert parts[2][0].startswith('Processing mic02.mrc')
+    assert 'RES_LIMIT 3.950' in parts[1][0] and 'RES_LIMIT 3.950' not in parts[2][0]
+    assert parts[2][0].rstrip('\n').endswith('Writing the star file micrographs_gctf.star')
+
+
+def test_batch_output_from_lines():
+    inputs = ['mic00.mrc', 'mic01.mrc', 'mic02.mrc']
+    with open(data_file('gctf_batch.log')) as f:
+        from_file = parse_output(f, inputs)
+    assert [values for _, values in from_file] == [values for _, values in parse_output(read('gctf_batch.log'), inputs)]
+
+
+def test_batch_output_split_by_final_values():
+    # the names of the files are not in the output
+    parts = parse_output(read('gctf_batch_unnamed.log'), ['mic00.mrc', 'mic01.mrc'])
+    assert [values['Defocus_U'] for _, values in parts] == [21402.19, 18204.55]
+    assert parts[0][0].endswith('Final Values')
+    # the lines after the last final values belong to the last file
+    assert 'RES_LIMIT 3.950' in parts[1][0]
+    assert parts[1][0].rstrip('\n').endswith('Writing the star file micrographs_gctf.star')
+
+
+def test_output_with_missing_values():
+    # gctf gave up on the last file
+    assert parse_output(read('gctf_batch_unnamed.log'), ['mic00.mrc', 'mic01.mrc', 'mic02.mrc']) is None
+    assert parse_output('', ['mic00.mrc']) is None
+
+
+def test_epa_log_keeps_first_row():
+    epa = read_epa_log(data_file('mic00_EPA.log'))
+    assert epa.shape == (5, len(EPA_COLUMNS))
+    assert epa[0, EPA_COLUMNS.index('Resolution')] == 20.0
+    assert epa[-1, EPA_COLUMNS.index('Resolution')] == 3.0
+
+
+@pytest.mark.parametrize('cc_cutoff, resolution', [
+    (0.5, 4.0),     # the first resolution below the cutoff
+    (0.75, 6.0),
+    (0.995, 20.0),  # already the first row is below
+])
+def test_resolution_at_cutoff(cc_cutoff, resolution):
+    assert resolution_at_cutoff(read_epa_log(data_file('mic00_EPA.log')), cc_cutoff) == resolution
+
+
+def test_resolution_never_below_cutoff():
+    assert resolution_at_cutoff(read_epa_log(data_file('mic01_EPA.log')), 0.1) == 5.0
+
+
+def test_star_file_in_order_of_inputs():
+    inputs = ['/data/output/gctf/mic00.mrc', '/data/output/gctf/mic01.mrc', '/data/output/gctf/mic02.mrc']
+    columns, rows = read_star_file(data_file('micrographs_gctf.star'), inputs)
+    assert columns == ['_rlnMicrographName #1', '_rlnCtfImage #2', '_rlnDefocusU #3', '_rlnDefocusV #4', '_rlnDefocusAngle #5']
+    # gctf wrote mic01 first
+    assert [row[0] for row in rows] == inputs
+    assert rows[1][2] == '18204.55'
+
+
+def test_star_file_without_names():
+    # the rows of unknown files belong to the last micrographs that were written
+    columns, rows = read_star_file(data_file('micrographs_gctf.star'), ['other_a.mrc', 'other_b.mrc'])
+    assert [os.path.basename(row[0]) for row in rows] == ['mic00.mrc', 'mic02.mrc']
@@ -0,0 +1,74 @@
+"""
+Tests of the circuit breaker of the GPUs
+"""
+import time
+import logging
+
+from pipeline import GpuHealth
+
+
+def quarantined_gpu(cooldown=0.0):
+    health = GpuHealth([0, 1], logging.getLogger('test'), max_failures=2, cooldown=cooldown)
+    health.failure(0)
+    health.failure(0)
+    return health
+
+
+def test_quarantine_after_consecutive_failures():
+    health = GpuHealth([0], logging.getLogger('test'), max_failures=3, cooldown=300.0)
+    health.failure(0)
+    health.success(0)
+    health.failure(0)
+    health.failure(0)
+    assert health.acquire(0)
+    health.failure(0)
+    assert health.state[0] == GpuHealth.QUARANTINED
+    assert not health.acquire(0)
+    assert health.healthy() == []
+
+
+def test_successful_probe():
+    health = quarantined_gpu()
+    assert health.acquire(0)
+    assert health.state[0] == GpuHealth.PROBING
+    # only a single probe at a time
+    assert not health.acquire(0)
+    health.success(0)
+    assert health.state[0] == GpuHealth.HEALTHY
+    assert health.acquire(0)
+
+
+def test_failed_probe():
+    health = quarantined_gpu()
+    assert health.acquire(0)
+    health.failure(0)
+    assert health.state[0] == GpuHealth.QUARANTINED
+    assert health.quarantined_until[0] <= time.time()
+
+
+def test_released_probe():
+    health = quarantined_gpu(cooldown=300.0)
+    health.quarantined_until[0] = 0.0
+    assert health.acquire(0)
+    # e.g. the probe was a micrograph that failed on the GPU before
+    health.release(0)
+    assert health.state[0] == GpuHealth.QUARANTINED
+    assert health.quarantined_until[0] > time.time()
+    assert health.failures[0] == 2
+    # after the next cooldown there is another probe
+    health.quarantined_until[0] = 0.0
+    assert health.acquire(0)
+
+
+def test_release_of_healthy_gpu():
+    health = GpuHealth([0], logging.getLogger('test'))
+    health.release(0)
+    assert health.state[0] == GpuHealth.HEALTHY
+
+
+def test_success_during_quarantine():
+    # a job that was started before the quarantine does not lift it
+    health = quarantined_gpu(cooldown=300.0)
+    health.success(0)
+    assert health.state[0] == GpuHealth.QUARANTINED
+    assert health.healthy() == [1]
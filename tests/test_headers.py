@@ -0,0 +1,168 @@
+"""
+Tests of the header checks of the frame files and of the readiness gate, with small
+MRC and TIFF files that are truncated and completed
+"""
+import os
+import struct
+import logging
+
+import numpy as np
+import mrcfile
+
+from headers import check_file, validate_header, COMPLETE, INCOMPLETE, UNKNOWN, MISSING
+from watcher import ReadinessGate
+
+
+def write_mrc(path, frames=3, width=16, height=12, dtype=np.int8):
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(np.zeros((frames, height, width), dtype))
+    return os.path.getsize(path)
+
+
+def write_tiff(path, pages=3, width=16, height=12, declared_pages=None):
+    """
+    Uncompressed 8 bit TIFF with one strip per page, like the detectors write them.
+    The first image directory declares the number of pages with the PageNumber tag
+    """
+    declared_pages = pages if declared_pages is None else declared_pages
+    entries = 6
+    ifd_size = 2 + 12 * entries + 4
+    data_size = width * height
+    with open(path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, 8))
+        for page in range(pages):
+            offset = 8 + page * (ifd_size + data_size)
+            next_offset = offset + ifd_size + data_size if page < pages - 1 else 0
+            f.write(struct.pack('<H', entries))
+            f.write(struct.pack('<HHII', 256, 4, 1, width))                     # ImageWidth
+            f.write(struct.pack('<HHII', 257, 4, 1, height))                    # ImageLength
+            f.write(struct.pack('<HHIHH', 258, 3, 1, 8, 0))                     # BitsPerSample
+            f.write(struct.pack('<HHII', 273, 4, 1, offset + ifd_size))         # StripOffsets
+            f.write(struct.pack('<HHII', 279, 4, 1, data_size))                 # StripByteCounts
+            f.write(struct.pack('<HHIHH', 297, 3, 2, page, declared_pages))     # PageNumber
+            f.write(struct.pack('<I', next_offset))
+            f.write(bytes(data_size))
+    return os.path.getsize(path)
+
+
+def truncate(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+
+def test_complete_mrc(tmp_path):
+    path = str(tmp_path / 'frames.mrc')
+    size = write_mrc(path)
+    readiness = check_file(path)
+    assert readiness.state == COMPLETE
+    assert readiness.expected == size
+    assert (readiness.pages, readiness.width, readiness.height, readiness.pixel_type) == (3, 16, 12, 'int8')
+
+
+def test_truncated_mrc(tmp_path):
+    path = str(tmp_path / 'frames.mrc')
+    size = write_mrc(path, dtype=np.float32)
+    truncate(path, size - 100)
+    readiness = check_file(path)
+    assert readiness.state == INCOMPLETE
+    assert (readiness.size, readiness.expected) == (size - 100, size)
+    # only a part of the header
+    truncate(path, 500)
+    assert check_file(path).state == INCOMPLETE
+
+
+def test_complete_tiff(tmp_path):
+    path = str(tmp_path / 'frames.tif')
+    size = write_tiff(path)
+    readiness = check_file(path)
+    assert readiness.state == COMPLETE
+    assert readiness.expected == size
+    assert (readiness.pages, readiness.width, readiness.height, readiness.pixel_type) == (3, 16, 12, 'uint8')
+
+
+def test_truncated_tiff(tmp_path):
+    path = str(tmp_path / 'frames.tif')
+    size = write_tiff(path)
+    for length in (size - 10, size // 2, 50, 4):
+        truncate(path, length)
+        assert check_file(path).state == INCOMPLETE, length
+
+
+def test_tiff_with_missing_pages(tmp_path):
+    # the writer did not append the last page yet
+    path = str(tmp_path / 'frames.tif')
+    write_tiff(path, pages=2, declared_pages=3)
+    readiness = check_file(path)
+    assert readiness.state == INCOMPLETE
+    assert readiness.pages == 3
+
+
+def test_other_files(tmp_path):
+    path = str(tmp_path / 'frames.dat')
+    with open(path, 'wb') as f:
+        f.write(bytes(100))
+    assert check_file(path).state == UNKNOWN
+    assert check_file(str(tmp_path / 'missing.mrc')).state == MISSING
+
+
+def test_validate_header(tmp_path):
+    write_mrc(str(tmp_path / 'reference.mrc'))
+    reference = check_file(str(tmp_path / 'reference.mrc'))
+    write_mrc(str(tmp_path / 'same.mrc'))
+    assert validate_header(check_file(str(tmp_path / 'same.mrc')), reference) == []
+    write_tiff(str(tmp_path / 'first.tif'))
+    write_tiff(str(tmp_path / 'same.tif'))
+    assert validate_header(check_file(str(tmp_path / 'same.tif')), check_file(str(tmp_path / 'first.tif'))) == []
+
+    write_mrc(str(tmp_path / 'gain.mrc'), frames=1, width=12, height=16, dtype=np.float32)
+    gain = check_file(str(tmp_path / 'gain.mrc'))
+    # the gain reference may be rotated by 90 degrees
+    assert validate_header(reference, gain=gain) == []
+
+    write_mrc(str(tmp_path / 'larger.mrc'), width=32)
+    larger = check_file(str(tmp_path / 'larger.mrc'))
+    assert len(validate_header(larger, gain=gain)) == 1
+    assert len(validate_header(larger, reference)) == 1
+
+    write_mrc(str(tmp_path / 'fewer.mrc'), frames=2)
+    problems = validate_header(check_file(str(tmp_path / 'fewer.mrc')), reference)
+    assert len(problems) == 1 and 'number of frames' in problems[0]
+
+    write_mrc(str(tmp_path / 'float.mrc'), dtype=np.float32)
+    problems = validate_header(check_file(str(tmp_path / 'float.mrc')), reference)
+    assert len(problems) == 1 and 'pixel type' in problems[0]
+
+
+def test_gate_passes_complete_files(tmp_path):
+    path = str(tmp_path / 'frames.mrc')
+    size = write_mrc(path)
+    truncate(path, size - 10)
+    passed = []
+    gate = ReadinessGate(passed.append, logging.getLogger('test'), stable_time=0.0, truncated_time=60.0)
+    gate.add(path)
+    assert passed == [] and len(gate) == 1
+    write_mrc(path)
+    assert gate.check() == 1
+    assert passed == [path] and len(gate) == 0
+
+
+def test_gate_dispatches_truncated_file_that_is_completed(tmp_path):
+    path = str(tmp_path / 'frames.tif')
+    size = write_tiff(path)
+    truncate(path, size - 10)
+    passed, truncated = [], []
+    gate = ReadinessGate(passed.append, logging.getLogger('test'), lambda path, readiness: truncated.append(path),
+                         stable_time=0.0, truncated_time=0.0)
+    gate.add(path)
+    gate.check()
+    assert truncated == [path] and passed == []
+    # the size did not change, it stays truncated
+    gate.check()
+    assert truncated == [path] and passed == [] and len(gate) == 0
+
+    # the copy was resumed
+    write_tiff(path)
+    gate.check() # waits for it again
+    gate.check()
+    assert passed == [path]
+    assert truncated == [path]
@@ -0,0 +1,50 @@
+"""
+Tests of resuming the micrographs from the ledger after a restart
+"""
+import logging
+
+from pipeline import Ledger, Micrograph
+
+
+def micrograph(tmp_path):
+    path = tmp_path / 'frames' / 'mic00.mrc'
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(b'')
+    return Micrograph(str(path), logging.getLogger('test'))
+
+
+def test_done_without_gctf_result(tmp_path):
+    ledger = Ledger(str(tmp_path))
+    failed = micrograph(tmp_path)
+    failed.files['gctf_input'] = str(tmp_path / 'mic00_aligned.mrc') # gctf failed
+    ledger.record(failed, 'done')
+
+    restored = micrograph(tmp_path)
+    assert ledger.restore(restored) == 'done'
+    assert restored.files['gctf_input'] == failed.files['gctf_input']
+    assert len(ledger.load_records()) == 1
+    ledger.close()
+
+
+def test_missing_output_files(tmp_path):
+    ledger = Ledger(str(tmp_path))
+    aligned = micrograph(tmp_path)
+    aligned.files['gctf_input'] = str(tmp_path / 'mic00_aligned.mrc')
+    ledger.record(aligned, 'motioncor')
+    # the aligned micrograph was deleted, so motioncor runs again
+    assert ledger.restore(micrograph(tmp_path)) is None
+
+    (tmp_path / 'mic00_aligned.mrc').write_bytes(b'')
+    assert ledger.restore(micrograph(tmp_path)) == 'motioncor'
+    ledger.close()
+
+
+def test_raw_file_is_kept(tmp_path):
+    ledger = Ledger(str(tmp_path))
+    done = micrograph(tmp_path)
+    done.files['raw'] = '/elsewhere/mic00.mrc'
+    ledger.record(done, 'done')
+    restored = micrograph(tmp_path)
+    ledger.restore(restored)
+    assert restored.files['raw'] == str(tmp_path / 'frames' / 'mic00.mrc')
+    ledger.close()
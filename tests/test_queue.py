@@ -0,0 +1,47 @@
+"""
+Tests of the order in which the queue hands out the micrographs
+"""
+import logging
+
+from pipeline import MicrographQueue, Micrograph
+
+
+def micrograph(tmp_path, name, size, frames=None, width=None, height=None, source='watch'):
+    path = tmp_path / (name + '.mrc')
+    path.write_bytes(bytes(size))
+    micrograph = Micrograph(str(path), logging.getLogger('test'), source=source)
+    micrograph.frames, micrograph.width, micrograph.height = frames, width, height
+    return micrograph
+
+
+def order(queue, micrographs):
+    for m in micrographs:
+        queue.put(m)
+    return [queue.get().basename for _ in micrographs]
+
+
+def test_smallest_by_pixels(tmp_path):
+    # the compressed stack is the smallest file, but it has the most pixels
+    micrographs = [micrograph(tmp_path, 'large', 3000, 40, 8, 8),
+                   micrograph(tmp_path, 'compressed', 100, 60, 8, 8),
+                   micrograph(tmp_path, 'few_frames', 2000, 10, 8, 8)]
+    assert order(MicrographQueue('smallest'), micrographs) == ['few_frames', 'large', 'compressed']
+
+
+def test_smallest_without_header(tmp_path):
+    micrographs = [micrograph(tmp_path, 'b', 300), micrograph(tmp_path, 'a', 100), micrograph(tmp_path, 'c', 200)]
+    assert order(MicrographQueue('smallest'), micrographs) == ['a', 'c', 'b']
+
+
+def test_fifo_and_manual_last(tmp_path):
+    micrographs = [micrograph(tmp_path, 'first', 10, source='manual'), micrograph(tmp_path, 'second', 10),
+                   micrograph(tmp_path, 'third', 10)]
+    assert order(MicrographQueue('fifo'), micrographs) == ['first', 'second', 'third']
+    assert order(MicrographQueue('manual_last'), micrographs) == ['second', 'third', 'first']
+
+
+def test_none_comes_first(tmp_path):
+    queue = MicrographQueue('smallest')
+    queue.put(micrograph(tmp_path, 'a', 10))
+    queue.put(None)
+    assert queue.get() is None
@@ -0,0 +1,28 @@
+"""
+Tests of the png files of the aligned micrographs and the CTF fits
+"""
+import os
+
+import numpy as np
+import mrcfile
+
+from pipeline import create_static_files
+
+
+def test_thumbnails_are_named_after_the_image(tmp_path):
+    input_mrc = str(tmp_path / 'mic00.mrc')
+    with mrcfile.new(input_mrc) as mrc:
+        mrc.set_data(np.random.rand(64, 64).astype(np.float32))
+    log_file = str(tmp_path / 'mic00_gctf.log')
+    with open(log_file, 'w') as f:
+        f.write('log\n')
+    static_dir = tmp_path / 'static'
+    static_dir.mkdir()
+
+    # the log file comes first in the dictionary
+    data = {'gctf_log': 'static/gctf/mic00_gctf.log', 'gctf_ctf_fit': 'static/gctf/mic00.png'}
+    result = create_static_files(input_mrc, log_file, str(static_dir), False, 'gctf_ctf_fit', data, thumbnail_sizes=(16, 32))
+    assert result['gctf_ctf_fit_32'] == 'static/gctf/mic00_32.png'
+    assert 'gctf_log_32' not in result
+    assert sorted(os.listdir(str(static_dir))) == ['mic00.png', 'mic00_32.png', 'mic00_gctf.log']
+    assert result['gctf_thumbnail_bytes'] > 0